@@ -1,5 +1,6 @@
-from collections import Counter, defaultdict
+import numpy as np
 from BITS.seq.align import EdlibRunner
+from .pileup import gap_code, encode_seq, pileup, majority_vote, vote_consensus
 
 
 class PairwiseAlignment:
@@ -34,36 +35,6 @@ class PairwiseAlignment:
             print(''.join([' ' if c == '=' else self.target[i] for i, c in enumerate(self.fcigar)]))
 
 
-def count_variants(cluster_cons_unit, cluster_units):
-    """Given a set of unit sequences <units> in a cluster, calculate the composition of
-    nucleotides including '-' (= distribution of each )
-    for each position on <cluster_cons_unit> as a seed.
-    from which <units> are generated, compute the variations (= nucleotides inconsistent between
-    <units> and <cluster_cons_unit> and their relative frequency).
-    Since a cluster should be homogeneous (i.e., mono-source), the relative frequencies are
-    expected to be not much larger than sequencing error.
-    """
-    assert cluster_cons_unit != "", "Empty strings are not allowed"
-    # TODO: how to decide "same variant?" especially for multiple variations on same position (but slightly different among units)?
-    variants = Counter()
-    for unit in cluster_units:
-        assert unit != "", "Empty strings are not allowed"
-        alignment = PairwiseAlignment(cluster_cons_unit, unit)   # alignment.fcigar(cluster_cons_unit) = unit
-        tpos = 0
-        var_index = 0   # positive values for continuous insertions
-        for i, c in enumerate(alignment.fcigar):
-            if c == '=':
-                var_index = 0
-            elif c == 'I':
-                var_index += 1
-            if c != '=':
-                variants[(tpos, var_index, c, alignment.target[i])] += 1   # TODO: multiple D on the same pos are aggregated
-            if c != 'I':
-                tpos += 1
-        assert tpos == len(cluster_cons_unit)
-    return variants
-
-
 def consensus_alt(in_seqs, seed_choice="original"):
     """Compute a consensus sequence among `seqs: List[str]` by a simple majority vote for each position
     of the alignment pileup that is made by globally aligning a seed sequence and each of the other sequences.
@@ -77,34 +48,9 @@ def consensus_alt(in_seqs, seed_choice="original"):
             index = len(in_seqs) // 2
             in_seqs = [in_seqs[index]] + in_seqs[:index] + in_seqs[index + 1:]
             
-    var_counts = count_variants(in_seqs[0], in_seqs[1:])
-
-    freqs = defaultdict(list)
-    for (pos, subpos, _type, base), count in var_counts.items():
-        freqs[(pos, subpos)].append((base, count))
-        
-    cons = ""
-
-    for pos in range(len(in_seqs[0]) + 1):
-        subpos = 1
-        # insertions
-        while (pos, subpos) in freqs:
-            base_counts = Counter({'a': 0, 'c': 0, 'g': 0, 't': 0, '-': 0})
-            for base, count in freqs[(pos, subpos)]:
-                base_counts[base] = count
-            base_counts['-'] = len(in_seqs) - sum(base_counts.values())
-            cons += base_counts.most_common()[0][0]
-            subpos += 1
-        if pos == len(in_seqs[0]):
-            break
-        # others
-        if (pos, 0) not in freqs:
-            cons += in_seqs[0][pos]
-        else:
-            base_counts = Counter({'a': 0, 'c': 0, 'g': 0, 't': 0, '-': 0})
-            for base, count in freqs[(pos, 0)]:
-                base_counts[base] = count
-            base_counts[in_seqs[0][pos]] = len(in_seqs) - sum(base_counts.values())
-            cons += base_counts.most_common()[0][0]
-
-    return cons.replace('-', '')
+    # Pileup with the vote of the seed itself
+    seed = in_seqs[0]
+    counts = pileup(seed, in_seqs[1:])
+    counts[np.arange(len(seed)), 0, encode_seq(seed)] += 1
+    counts[:, 1:, gap_code] += 1
+    return vote_consensus(seed, counts, majority_vote(counts))   # ties are broken by the order of 'acgt-'
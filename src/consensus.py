@@ -0,0 +1,93 @@
+import time
+from logzero import logger
+from BITS.seq.align import EdlibRunner
+from .alt_consensus import consensus_alt
+from .pileup import pileup, majority_vote, vote_consensus
+
+# Available consensus engines.
+#   "consed": The Consed extension (imported only when used)
+#   "pileup": Majority vote on the pileup tensor with iterative re-seeding (pure Python/NumPy)
+consensus_engines = ("consed", "pileup")
+
+er_global = EdlibRunner("global", revcomp=False, cyclic=False)
+er_glocal = EdlibRunner("glocal", revcomp=False, cyclic=False)
+
+
+def consensus(seqs, engine="consed", **kwargs):
+    """Compute a consensus sequence of <seqs> with the consensus engine <engine>.
+    An empty string is returned if the consensus could not be computed.
+    <kwargs> are passed to the engine, and both engines accept:
+
+      @ seed_choice <str> : How to choose the initial seed: "original" (= the first sequence),
+                            "median" or "longest" in terms of length.
+      @ n_iter      <int> : Number of rounds of the pileup re-seeded by the previous consensus.
+      @ error_msg   <str> : Message shown when the consensus failed.
+    """
+    assert engine in consensus_engines, f"Invalid consensus engine: {engine}"
+    if engine == "consed":
+        import consed
+        return consed.consensus(seqs, **kwargs)
+    return pileup_consensus(seqs, **kwargs)
+
+
+def pileup_consensus(seqs, seed_choice="median", n_iter=1, error_msg=""):
+    """Consensus by majority vote on the pileup of <seqs>. The first round is `consensus_alt` on a seed
+    chosen by <seed_choice>, and each of the following rounds votes on the pileup of <seqs> aligned to the
+    consensus of the previous round (whose bases win ties), until <n_iter> rounds or convergence."""
+    seqs = [seq for seq in seqs if seq != ""]
+    if len(seqs) == 0:
+        logger.warning(f"No sequences for consensus: {error_msg}")
+        return ""
+    cons = consensus_alt(seqs, seed_choice=seed_choice)
+    for i in range(n_iter - 1):
+        if cons == "":
+            break
+        counts = pileup(cons, seqs)
+        new_cons = vote_consensus(cons, counts, majority_vote(counts, cons))
+        if new_cons == cons:
+            break
+        cons = new_cons
+    if cons == "":
+        logger.warning(f"Empty consensus: {error_msg}")
+    return cons
+
+
+def rotate_to_seed(seq, seed):
+    """Rotate a cyclic sequence <seq> (e.g. a tandem repeat unit) so that it starts at the phase where
+    <seed> starts."""
+    if len(seq) == 0 or len(seed) == 0:
+        return seq
+    start = er_glocal.align(seed, seq + seq).t_start % len(seq)
+    return seq[start:] + seq[:start]
+
+
+def benchmark_engines(engines=consensus_engines, unit_length=360, n_units_list=(5, 10, 20, 50),
+                      edit_weights=(88, 4, 4, 4), n_iter=3, n_trials=10, seed=0):
+    """Compare the accuracy and the runtime of the consensus engines on units simulated with `vca.simulator`
+    from a random true unit with sequencing errors <edit_weights> (= weights of {=, X, I, D}).
+    Return value is a DataFrame with the sequence difference of each consensus from the true unit.
+    """
+    import pandas as pd
+    from .simulator.core import set_seed, gen_unique_seq, sequence_seq
+
+    set_seed(seed)
+    results = []
+    for n_units in n_units_list:
+        for trial in range(n_trials):
+            true_unit = gen_unique_seq(unit_length)
+            units = [sequence_seq(true_unit, edit_weights) for i in range(n_units)]
+            for engine in engines:
+                start = time.perf_counter()
+                cons = consensus(units, engine=engine, n_iter=n_iter,
+                                 error_msg=f"benchmark (n_units={n_units}, trial={trial})")
+                runtime = time.perf_counter() - start
+                results.append((engine, n_units, trial, runtime, len(cons),
+                                1. if cons == "" else er_global.align(cons, true_unit).diff))
+    return pd.DataFrame(results, columns=("engine", "n_units", "trial", "time", "length", "diff"))
+
+
+def summarize_benchmark(df):
+    """Mean accuracy and runtime for each engine and each number of units."""
+    return (df.groupby(["engine", "n_units"])[["time", "diff"]].mean()
+              .reset_index()
+              .sort_values(by=["n_units", "engine"]))
@@ -1,9 +1,9 @@
 from collections import defaultdict, Counter
 from logzero import logger
-import consed
 from BITS.seq.utils import reverse_seq
 from BITS.seq.align import EdlibRunner
 from .types import Overlap, revcomp_read
+from .consensus import consensus
 from .overlapper.overlap_filter import read_id_to_overlaps
 from .graph import edges_to_contig
 
@@ -93,7 +93,7 @@ def cut_seq(ctg_start, ctg_end, read_seq, fcigar, window_start, window_end):
     return seq
 
 
-def consensus_contig(ctg, edges, overlaps, tr_reads_by_id, window_size):
+def consensus_contig(ctg, edges, overlaps, tr_reads_by_id, window_size, cons_engine="consed"):
     read_pos = []
     pos = 0
     read_id, node_type = edges[0]["source"].split(':')
@@ -127,18 +127,18 @@ def consensus_contig(ctg, edges, overlaps, tr_reads_by_id, window_size):
         if len(window_seqs) == 1:
             cons += window_seqs[0]
         else:
-            cons += consed.consensus(window_seqs, n_iter=3)
+            cons += consensus(window_seqs, engine=cons_engine, n_iter=3)
     return cons
 
 
-def reduced_graph_to_contigs(g, overlaps, tr_reads_by_id, window_size=1000):
+def reduced_graph_to_contigs(g, overlaps, tr_reads_by_id, window_size=1000, cons_engine="consed"):
     out_nodes = set([e["target"] for e in g.es])
     cons_contigs = []
     for e in list(g.es):
         edges = e["edges"]
         contig = edges_to_contig(edges, tr_reads_by_id)
         logger.info(f"Edge {e['source']} -> {e['target']}: {len(contig)} bp (uncorrected)")
-        cons_contig = consensus_contig(contig, edges, overlaps, tr_reads_by_id, window_size)
+        cons_contig = consensus_contig(contig, edges, overlaps, tr_reads_by_id, window_size, cons_engine)
         logger.info(f"Edge {e['source']} -> {e['target']}: {len(cons_contig)} bp (corrected)")
         cons_contigs.append(cons_contig)
     return cons_contigs
@@ -1,8 +1,10 @@
+import numpy as np
 from logzero import logger
 import igraph as ig
 import plotly.graph_objs as go
 from BITS.plot.plotly import make_line, make_scatter, show_plot
 from BITS.seq.utils import revcomp_seq
+from .types import array_to_overlaps
 
 
 def convert_overlap(overlap):
@@ -71,7 +73,11 @@ def convert_overlap(overlap):
 def overlaps_to_string_graph(overlaps):
     """Construct a string graph from `overlaps` <List[Overlap]>. All the overlaps given here are
     treated as true overlaps. That is, filtering of the overlaps must be finished in advance.
+    A structured array of `overlap_dtype` is also accepted as `overlaps`.
     """
+    if isinstance(overlaps, np.ndarray):
+        overlaps = array_to_overlaps(overlaps)
+
     # Modify `g_[start|end]` and list up contained reads
     converted_overlaps = [convert_overlap(overlap) for overlap in overlaps]
     contained_reads = set()
@@ -12,6 +12,7 @@ from .svs_unsync_reads import svs_overlap
 
 out_dir        = "ava_unsync"
 out_prefix     = "ovlps"
+index_prefix   = "index"
 scatter_prefix = "run_ava_unsync"
 gather_fname   = f"{out_dir}/gather.sh"
 log_prefix      = f"{out_dir}/log"
@@ -32,6 +33,15 @@ class UnsyncReadsOverlapper:
           : File of centromere reads
       @ out_fname              <str>       ["centromere_reads_unsync_overlaps.pkl"]
           : Output file name
+      @ index_fname            <str>       ["centromere_reads_unsync_index.pkl"]
+          : Output file name of the k-mer spectrums of the reads, which are reused when new reads
+            are added later.
+      @ base_out_fname         <str>       [None]
+          : Existing output (overlaps) for a subset of the reads. If given, only overlaps for
+            (new x old) and (new x new) read pairs are computed and merged into it, where "old"
+            reads are those in `base_index_fname`.
+      @ base_index_fname       <str>       [None]
+          : `index_fname` of the run which computed `base_out_fname`.
       @ offset                 <int>       [1]
           : `offset` units around both boundaries of a read are not used as k-units.
       @ k_for_unit             <int>       [2]
@@ -45,20 +55,29 @@ class UnsyncReadsOverlapper:
           : Threshold for initial `k`-unit mapping.
       @ max_diff               <float>     [0.02]
           : Threshold for sequence dissimilarity of final overlaps.
+      @ max_diag_slip          <int>       [20]
+          : Match positions whose diagonals differ by at most this value [bp] are regarded as
+            same overlap, and only one of them is verified by dovetail alignment.
     """
     n_distribute           : int
     n_core                 : int
     scheduler              : Scheduler = Scheduler("sge", "qsub", "all.q")
     centromere_reads_fname : str       = "centromere_reads.pkl"
     out_fname              : str       = "centromere_reads_unsync_overlaps.pkl"
+    index_fname            : str       = "centromere_reads_unsync_index.pkl"
+    base_out_fname         : str       = None
+    base_index_fname       : str       = None
     offset                 : int       = 1
     k_for_unit             : int       = 2
     k_for_spectrum         : int       = 13
     min_kmer_ovlp          : float     = 0.4
     max_init_diff          : float     = 0.02
     max_diff               : float     = 0.02
+    max_diag_slip          : int       = 20
 
     def __post_init__(self):
+        assert (self.base_out_fname is None) == (self.base_index_fname is None), \
+            "`base_out_fname` and `base_index_fname` must be given together"
         run_command(f"mkdir -p {out_dir}; rm -f {out_dir}/*")
 
     def run(self):
@@ -66,11 +85,13 @@ class UnsyncReadsOverlapper:
         for i in range(self.n_distribute):
             index = str(i + 1).zfill(int(np.log10(self.n_distribute) + 1))
             out_fname = f"{out_dir}/{out_prefix}.{index}.pkl"
+            index_fname = f"{out_dir}/{index_prefix}.{index}.pkl"
             script_fname = f"{out_dir}/{scatter_prefix}.{index}.sh"
 
             script = ' '.join(map(str, ["python -m vca.overlapper.ava_unsync_reads",
                                         self.centromere_reads_fname,
                                         out_fname,
+                                        index_fname,
                                         self.n_distribute,
                                         self.n_core,
                                         self.offset,
@@ -79,7 +100,10 @@ class UnsyncReadsOverlapper:
                                         self.min_kmer_ovlp,
                                         self.max_init_diff,
                                         self.max_diff,
-                                        i]))
+                                        self.max_diag_slip,
+                                        i]
+                                + ([] if self.base_index_fname is None
+                                   else ["--base_index_fname", self.base_index_fname])))
 
             jids.append(self.scheduler.submit(script,
                                               script_fname,
@@ -94,18 +118,48 @@ class UnsyncReadsOverlapper:
                               depend=jids,
                               wait=True)
 
-        merged = []
+        merged = [] if self.base_out_fname is None else load_pickle(self.base_out_fname)
         fnames = run_command(f"find {out_dir} -name '{out_prefix}.*' | sort").strip().split('\n')
         for fname in fnames:
             merged += load_pickle(fname)
         save_pickle(sorted(merged), self.out_fname)
 
+        index = (dict(offset=self.offset, k_for_unit=self.k_for_unit,
+                      k_for_spectrum=self.k_for_spectrum, forward_specs={}, boundary_specs={})
+                 if self.base_index_fname is None else load_pickle(self.base_index_fname))
+        fnames = run_command(f"find {out_dir} -name '{index_prefix}.*' | sort").strip().split('\n')
+        for fname in fnames:
+            forward_specs, boundary_specs = load_pickle(fname)
+            index["forward_specs"].update(forward_specs)
+            index["boundary_specs"].update(boundary_specs)
+        save_pickle(index, self.index_fname)
+
+
+def calc_kmer_specs(reads, offset, k_for_unit, k_for_spectrum):
+    """Compute k-mer spectrums of the whole sequences and the boundary k-units of `reads`."""
+    read_forward_specs = {read.id: seq_to_forward_kmer_spectrum(read.seq, k=k_for_spectrum)
+                          for read in reads}
+    read_boundary_specs = {}
+    for read in reads:
+        for strand in (0, 1):
+            if strand == 1:
+                read = revcomp_read(read)
+            # prefix boundary
+            start, end = read.units[offset].start, read.units[offset + k_for_unit - 1].end
+            read_boundary_specs[(read.id, strand, start, end)] = \
+                seq_to_forward_kmer_spectrum(read.seq[start:end], k=k_for_spectrum)
+            # suffix boundary
+            start, end = read.units[-offset - k_for_unit].start, read.units[-offset - 1].end
+            read_boundary_specs[(read.id, strand, start, end)] = \
+                seq_to_forward_kmer_spectrum(read.seq[start:end], k=k_for_spectrum)
+    return (read_forward_specs, read_boundary_specs)
+
 
 def svs_overlap_mult(read_id_pairs,
-                     offset, k_for_unit, min_kmer_ovlp, max_init_diff, max_diff):
+                     offset, k_for_unit, min_kmer_ovlp, max_init_diff, max_diff, max_diag_slip):
     return [svs_overlap(reads[a_read_id], reads[b_read_id],
                         rc_reads[a_read_id], rc_reads[b_read_id],
-                        offset, k_for_unit, min_kmer_ovlp, max_init_diff, max_diff,
+                        offset, k_for_unit, min_kmer_ovlp, max_init_diff, max_diff, max_diag_slip,
                         read_forward_specs, read_boundary_specs)
             for a_read_id, b_read_id in read_id_pairs]
 
@@ -115,6 +169,7 @@ if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument("centromere_reads_fname", type=str)
     p.add_argument("out_fname", type=str)
+    p.add_argument("index_fname", type=str)
     p.add_argument("n_distribute", type=int)
     p.add_argument("n_core", type=int)
     p.add_argument("offset", type=int)
@@ -123,18 +178,30 @@ if __name__ == "__main__":
     p.add_argument("min_kmer_ovlp", type=float)
     p.add_argument("max_init_diff", type=float)
     p.add_argument("max_diff", type=float)
+    p.add_argument("max_diag_slip", type=int)
     p.add_argument("index", type=int)
+    p.add_argument("--base_index_fname", type=str, default=None)
     args = p.parse_args()
 
     # Load all reads
     centromere_reads = load_pickle(args.centromere_reads_fname)
     centromere_reads_by_id = {read.id: read for read in centromere_reads}
 
-    # List up read ID pairs assigned to this job
+    # Load k-mer spectrums of the reads already overlapped in the base run
+    base_forward_specs, base_boundary_specs = {}, {}
+    if args.base_index_fname is not None:
+        base_index = load_pickle(args.base_index_fname)
+        assert all([base_index[key] == getattr(args, key)
+                    for key in ("offset", "k_for_unit", "k_for_spectrum")]), \
+            "Parameters inconsistent with the base run"
+        base_forward_specs, base_boundary_specs = base_index["forward_specs"], base_index["boundary_specs"]
+
+    # List up read ID pairs assigned to this job, except (old x old) pairs
     read_id_pairs = [(a_read.id, b_read.id)
                      for a_read in centromere_reads
                      for b_read in centromere_reads
-                     if a_read.id < b_read.id]
+                     if a_read.id < b_read.id
+                     and not (a_read.id in base_forward_specs and b_read.id in base_forward_specs)]
     unit_n = -(-len(read_id_pairs) // args.n_distribute)
     read_id_pairs = read_id_pairs[args.index * unit_n:(args.index + 1) * unit_n]
 
@@ -146,27 +213,20 @@ if __name__ == "__main__":
     global read_boundary_specs
     reads = {read_id: centromere_reads_by_id[read_id] for read_id in read_ids}
     rc_reads = {read_id: revcomp_read(centromere_reads_by_id[read_id]) for read_id in read_ids}
-    read_forward_specs = {read.id: seq_to_forward_kmer_spectrum(read.seq, k=args.k_for_spectrum)
-                          for read in reads.values()}
-    read_boundary_specs = {}
-    for read in reads.values():
-        for strand in (0, 1):
-            if strand == 1:
-                read = revcomp_read(read)
-            # prefix boundary
-            start, end = read.units[args.offset].start, read.units[args.offset + args.k_for_unit - 1].end
-            read_boundary_specs[(read.id, strand, start, end)] = \
-                seq_to_forward_kmer_spectrum(read.seq[start:end], k=args.k_for_spectrum)
-            # suffix boundary
-            start, end = read.units[-args.offset - args.k_for_unit].start, read.units[-args.offset - 1].end
-            read_boundary_specs[(read.id, strand, start, end)] = \
-                seq_to_forward_kmer_spectrum(read.seq[start:end], k=args.k_for_spectrum)
+    read_forward_specs, read_boundary_specs = \
+        calc_kmer_specs([read for read in reads.values() if read.id not in base_forward_specs],
+                        args.offset, args.k_for_unit, args.k_for_spectrum)
+    save_pickle((read_forward_specs, read_boundary_specs), args.index_fname)
+    read_forward_specs.update({read_id: base_forward_specs[read_id]
+                               for read_id in read_ids if read_id in base_forward_specs})
+    read_boundary_specs.update({key: spec for key, spec in base_boundary_specs.items()
+                                if key[0] in read_ids})
 
     # Divide into read_pairs for each core
     unit_n = -(-len(read_id_pairs) // args.n_core)
     read_id_pairs_list = [(read_id_pairs[i * unit_n:(i + 1) * unit_n],
                            args.offset, args.k_for_unit, args.min_kmer_ovlp,
-                           args.max_init_diff, args.max_diff)
+                           args.max_init_diff, args.max_diff, args.max_diag_slip)
                           for i in range(args.n_core)]
 
     overlaps = set()
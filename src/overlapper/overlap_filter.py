@@ -1,78 +1,156 @@
 from collections import defaultdict, Counter
+import numpy as np
 from logzero import logger
 from BITS.plot.plotly import make_hist, make_layout, show_plot
 from BITS.util.union_find import UnionFind
+from ..types import overlaps_to_array
 
 
 def read_id_to_overlaps(read_id, overlaps):
     return list(filter(lambda o: o.a_read_id == read_id or o.b_read_id == read_id, overlaps))
 
 
+def _pair_starts(sorted_ovlps):
+    """Return the start indices of the read pairs (+ strand) in `sorted_ovlps` sorted by the pairs."""
+    return np.flatnonzero(np.concatenate(
+        [[True], np.any([sorted_ovlps[key][1:] != sorted_ovlps[key][:-1]
+                         for key in ("a_read_id", "b_read_id", "strand")], axis=0)]))
+
+
 def reduce_same_overlaps(overlaps, max_bp_slip=100):
     """Reduce overlaps having same positions into single overlap with the best score.
     Overlaps whose difference in bp is at most `max_bp_slip` are regarded as same.
+    `overlaps` can be either List[Overlap] or a structured array of `overlap_dtype`, and the
+    reduced overlaps are returned in the same type.
     """
-    def are_similar(x, y):
-        """Determine whether two overlaps, `x` and `y`, have similar overlapping positions."""
-        return (abs(x.a_start - y.a_start) <= max_bp_slip
-                and abs(x.a_end - y.a_end) <= max_bp_slip
-                and abs(x.b_start - y.b_start) <= max_bp_slip
-                and abs(x.b_end - y.b_end) <= max_bp_slip)
-
-    # Aggregate overlaps by read pair
-    ovlps_by_pair = defaultdict(list)
-    for o in overlaps:
-        ovlps_by_pair[(o.a_read_id, o.b_read_id, o.strand)].append(o)
-    # For each read pair, aggregate overlaps by position
-    reduced_overlaps = []
-    for read_pair, ovlps in ovlps_by_pair.items():
-        uf = UnionFind(len(ovlps))
-        for i in range(len(ovlps)):
-            for j in range(len(ovlps)):
-                if i >= j:
-                    continue
-                if uf.in_same_set(i, j):
-                    continue
-                if are_similar(ovlps[i], ovlps[j]):
-                    uf.unite(i, j)
-        ovlps_by_pos = {}
-        for i in range(len(ovlps)):
-            parent = uf.get_root(i)
-            if parent not in ovlps_by_pos or ovlps[i].diff < ovlps_by_pos[parent].diff:
-                ovlps_by_pos[parent] = ovlps[i]
-        reduced_overlaps += list(ovlps_by_pos.values())
+    ovlps = overlaps if isinstance(overlaps, np.ndarray) else overlaps_to_array(overlaps)
+    n = len(ovlps)
+    if n == 0:
+        return overlaps
+
+    # Sort by read pair and then by (a_start, b_start)
+    order = np.lexsort((ovlps["b_start"], ovlps["a_start"],
+                        ovlps["strand"], ovlps["b_read_id"], ovlps["a_read_id"]))
+    sorted_ovlps = ovlps[order]
+    pair_starts = _pair_starts(sorted_ovlps)
+    pair_ends = np.append(pair_starts[1:], n)
+
+    # For each read pair, sweep overlaps in the order of `a_start` and compare each overlap only
+    # with the preceding ones whose `a_start` is within `max_bp_slip`
+    uf = UnionFind(n)
+    a_starts, a_ends = sorted_ovlps["a_start"], sorted_ovlps["a_end"]
+    b_starts, b_ends = sorted_ovlps["b_start"], sorted_ovlps["b_end"]
+    for pair_start, pair_end in zip(pair_starts, pair_ends):
+        lefts = pair_start + np.searchsorted(a_starts[pair_start:pair_end],
+                                             a_starts[pair_start:pair_end] - max_bp_slip)
+        for i in range(pair_start, pair_end):
+            left = lefts[i - pair_start]
+            if left == i:
+                continue
+            similar = ((np.abs(b_starts[left:i] - b_starts[i]) <= max_bp_slip)
+                       & (np.abs(a_ends[left:i] - a_ends[i]) <= max_bp_slip)
+                       & (np.abs(b_ends[left:i] - b_ends[i]) <= max_bp_slip))
+            for j in left + np.flatnonzero(similar):
+                uf.unite(i, j)
+
+    # Choose the overlap with the smallest diff (and then the first one in the input) for each
+    # group of same overlaps, and keep the order of the first appearance of read pairs and groups
+    roots = np.array([uf.get_root(i) for i in range(n)], dtype=np.int64)
+    pair_first = np.repeat(np.minimum.reduceat(order, pair_starts), pair_ends - pair_starts)
+    group_order = np.lexsort((order, sorted_ovlps["diff"], roots))
+    best = group_order[np.concatenate([[True], np.diff(roots[group_order]) != 0])]
+    group_first = np.full(n, n, dtype=np.int64)
+    np.minimum.at(group_first, roots, order)
+    best = best[np.lexsort((group_first[roots[best]], pair_first[best]))]
+    best_indices = order[best]
+
+    reduced_overlaps = (ovlps[best_indices] if isinstance(overlaps, np.ndarray)
+                        else [overlaps[i] for i in best_indices])
     logger.info(f"#Overlaps: {len(overlaps)} -> {len(reduced_overlaps)}")
     return reduced_overlaps
 
 
 def filter_overlaps(overlaps, max_diff=2., min_ovlp_len=3000):
-    """Filter overlaps based on the maximum sequence dissimilarity and minimum overlap length."""
-    f = lambda o: ((o.a_end - o.a_start + o.b_end - o.b_start) // 2 >= min_ovlp_len
-                   and o.diff < max_diff)
-    filtered_overlaps = list(filter(f, overlaps))
+    """Filter overlaps based on the maximum sequence dissimilarity and minimum overlap length.
+    `overlaps` can be either List[Overlap] or a structured array of `overlap_dtype`, and the
+    filtered overlaps are returned in the same type.
+    """
+    ovlps = overlaps if isinstance(overlaps, np.ndarray) else overlaps_to_array(overlaps)
+    ovlp_lens = (ovlps["a_end"] - ovlps["a_start"] + ovlps["b_end"] - ovlps["b_start"]) // 2
+    indices = np.flatnonzero((ovlp_lens >= min_ovlp_len) & (ovlps["diff"] < max_diff))
+    filtered_overlaps = (ovlps[indices] if isinstance(overlaps, np.ndarray)
+                         else [overlaps[i] for i in indices])
     logger.info(f"#Overlaps: {len(overlaps)} -> {len(filtered_overlaps)}")
     return filtered_overlaps
 
 
 def best_overlaps_per_pair(overlaps):
     """Keep only one overlap for each read pair (+ strand), namely best-overlap logic for
-    slippy overlaps."""
-    ovlp_by_pair = {}
-    for o in overlaps:
-        read_pair = (o.a_read_id, o.b_read_id, o.strand)
-        if (read_pair not in ovlp_by_pair
-            or o.diff < ovlp_by_pair[read_pair].diff
-            or (o.diff == ovlp_by_pair[read_pair].diff
-                and o.a_end - o.a_start > ovlp_by_pair[read_pair].a_end - ovlp_by_pair[read_pair].a_start)):
-            ovlp_by_pair[read_pair] = o
-    best_overlaps = sorted(ovlp_by_pair.values())
+    slippy overlaps. The best overlap is the one with the smallest diff, and then the longest one.
+    `overlaps` can be either List[Overlap] or a structured array of `overlap_dtype`, and the
+    best overlaps are returned in the same type.
+    """
+    ovlps = overlaps if isinstance(overlaps, np.ndarray) else overlaps_to_array(overlaps)
+    if len(ovlps) == 0:
+        return overlaps
+    # Sort (stably) by read pair and then by the goodness of overlap; the first one for each pair
+    # is the best
+    order = np.lexsort((ovlps["a_start"] - ovlps["a_end"],
+                        ovlps["diff"],
+                        ovlps["strand"], ovlps["b_read_id"], ovlps["a_read_id"]))
+    indices = order[_pair_starts(ovlps[order])]
+    if isinstance(overlaps, np.ndarray):
+        # Same order as `sorted(List[Overlap])`, i.e., by all the fields
+        best_overlaps = ovlps[indices]
+        best_overlaps = best_overlaps[np.lexsort([best_overlaps[key]
+                                                  for key in reversed(best_overlaps.dtype.names)])]
+    else:
+        best_overlaps = sorted([overlaps[i] for i in indices])
     logger.info(f"#Overlaps: {len(overlaps)} -> {len(best_overlaps)}")
     return best_overlaps
 
 
 def best_overlaps(overlaps):
-    """Best-overlap logic, i.e., keep only one best in-edge and one best out-edge for each read."""
-    pass
+    """Best-overlap logic, i.e., keep only one best in-edge and one best out-edge for each read.
+    For each end (B and E) of each read, only the longest (and then the least different) dovetail
+    overlap on the end is kept. Overlaps with a contained read are all kept as they are so that
+    `overlaps_to_string_graph` can remove the contained reads.
+    `overlaps` can be either List[Overlap] or a structured array of `overlap_dtype`, and the
+    best overlaps are returned in the same type.
+    """
+    ovlps = overlaps if isinstance(overlaps, np.ndarray) else overlaps_to_array(overlaps)
+    if len(ovlps) == 0:
+        return overlaps
+
+    # Classify the overlaps in the same way as `graph.convert_overlap`
+    strand = ovlps["strand"]
+    f_start, f_end, f_len = ovlps["a_start"], ovlps["a_end"], ovlps["a_len"]
+    g_len = ovlps["b_len"]
+    g_start = np.where(strand == 0, ovlps["b_start"], g_len - ovlps["b_end"])
+    g_end = np.where(strand == 0, ovlps["b_end"], g_len - ovlps["b_start"])
+    f_suffix = f_start > 0
+    g_forward_end = np.where(strand == 0, g_end == g_len, g_start == 0)
+    g_reverse_end = np.where(strand == 0, g_start == 0, g_end == g_len)
+    containment = np.where(f_suffix, g_forward_end, (f_end == f_len) | g_reverse_end)
+    dovetail = np.flatnonzero(~containment)
+
+    # Ends of the reads on which each dovetail overlap is; 0 for B and 1 for E
+    a_ends = f_suffix[dovetail].astype(np.int64)
+    b_ends = (f_suffix[dovetail] != (strand[dovetail] == 0)).astype(np.int64)
+    read_ends = np.concatenate([ovlps["a_read_id"][dovetail] * 2 + a_ends,
+                                ovlps["b_read_id"][dovetail] * 2 + b_ends])
+    ovlp_indices = np.concatenate([dovetail, dovetail])
+
+    # Group the overlaps by read end and take the best one for each
+    ovlp_lens = (ovlps["a_end"] - ovlps["a_start"] + ovlps["b_end"] - ovlps["b_start"]) // 2
+    order = np.lexsort((ovlps["diff"][ovlp_indices], -ovlp_lens[ovlp_indices], read_ends))
+    firsts = np.flatnonzero(np.diff(read_ends[order], prepend=-1) != 0)
+    indices = np.union1d(ovlp_indices[order[firsts]], np.flatnonzero(containment))
+
+    filtered_overlaps = (ovlps[indices] if isinstance(overlaps, np.ndarray)
+                         else [overlaps[i] for i in indices])
+    logger.info(f"#Overlaps: {len(overlaps)} -> {len(filtered_overlaps)}")
+    return filtered_overlaps
 
 
 def plot_n_ovlps_per_read(overlaps, reads):
@@ -1,19 +1,24 @@
+import os
+import time
 import argparse
+import pickle
 from dataclasses import dataclass
-from collections import Counter, defaultdict
+from collections import Counter, defaultdict, OrderedDict
 from typing import List
-import random
 from copy import deepcopy
 import numpy as np
 from logzero import logger
-import consed
 from BITS.clustering.seq import ClusteringSeq
 from BITS.seq.align import EdlibRunner
-from BITS.seq.utils import phred_to_log10_p_error, phred_to_log10_p_correct
+from BITS.seq.utils import revcomp_seq, phred_to_log10_p_error, phred_to_log10_p_correct
 from BITS.util.io import save_pickle, load_pickle
 from BITS.util.proc import run_command, NoDaemonPool
 from BITS.util.scheduler import Scheduler
 from ..types import TRUnit, revcomp_read
+from ..consensus import consensus_engines, consensus, rotate_to_seed
+from ..profiler import profile, timer, count
+from ..pileup import (gap_code, fcigar_positions, align_columns, pileup, remove_columns,
+                      seed_codes, majority_vote, list_variants)
 
 out_dir = "smc_encode"
 out_prefix = "labeled_reads"
@@ -40,6 +45,18 @@ class SplitMergeClusteringOverlapper:
             be performed in advance.
       @ out_fname              <str>       ["labeled_reads.pkl"]
           : Output file name.
+      @ resume                 <bool>      [False]
+          : Keep the results of a previous run and restart only unfinished reads.
+      @ sync_group_size        <int>       [1]
+          : Maximum number of overlapping target reads whose units are synchronized at once.
+            1 means synchronization for each target read.
+      @ cons_engine            <str>       ["consed"]
+          : Consensus engine used for representative units and clusters. Must be one of `consensus_engines`.
+      @ seed                   <int>       [0]
+          : Base seed of the random number generators. Results are reproducible for the same seed
+            regardless of the number of jobs and cores.
+      @ max_time               <float>     [None]
+          : Time limit in seconds of the split-merge clustering for each read. No limit if None.
     """
     n_distribute: int
     n_core: int
@@ -49,15 +66,22 @@ class SplitMergeClusteringOverlapper:
     out_fname: str = "labeled_reads.pkl"
     ward_th: float = 0.01
     alpha: float = 1.
+    resume: bool = False
+    sync_group_size: int = 1
+    cons_engine: str = "consed"
+    seed: int = 0
+    max_time: float = None
 
     def __post_init__(self):
-        run_command(f"mkdir -p {out_dir}; rm -f {out_dir}/*")
+        run_command(f"mkdir -p {out_dir}" + ("" if self.resume else f"; rm -f {out_dir}/*"))
 
     def run(self):
         jids = []
         for i in range(self.n_distribute):
             index = str(i + 1).zfill(int(np.log10(self.n_distribute) + 1))
             out_fname = f"{out_dir}/{out_prefix}.{index}.pkl"
+            if self.resume and os.path.exists(out_fname):
+                continue
             script_fname = f"{out_dir}/{scatter_prefix}.{index}.sh"
             script = ' '.join(map(str, ["python -m vca.overlapper.split_merge_clustering_units",
                                         self.centromere_reads_fname,
@@ -67,7 +91,11 @@ class SplitMergeClusteringOverlapper:
                                         self.n_core,
                                         self.ward_th,
                                         self.alpha,
-                                        i]))
+                                        i,
+                                        f"--sync_group_size {self.sync_group_size}",
+                                        f"--cons_engine {self.cons_engine}",
+                                        f"--seed {self.seed}",
+                                        "" if self.max_time is None else f"--max_time {self.max_time}"]))
 
             jids.append(self.scheduler.submit(script,
                                               script_fname,
@@ -82,35 +110,115 @@ class SplitMergeClusteringOverlapper:
                               depend=jids,
                               wait=True)
 
+        # Gather the results, using the journal instead of the output for unfinished jobs
         labeled_reads = {}
-        fnames = run_command(
-            f"find {out_dir} -name '{out_prefix}.*.pkl' | sort").strip().split('\n')
-        for fname in fnames:
-            labeled_reads.update(load_pickle(fname))
+        for i in range(self.n_distribute):
+            index = str(i + 1).zfill(int(np.log10(self.n_distribute) + 1))
+            out_fname = f"{out_dir}/{out_prefix}.{index}.pkl"
+            if os.path.exists(out_fname):
+                labeled_reads.update(load_pickle(out_fname))
+            else:
+                logger.warning(f"{out_fname} does not exist. Use the journal of the job instead.")
+                labeled_reads.update(load_journal(f"{out_fname}.journal"))
+
+        overlaps = load_pickle(self.overlaps_fname)
+        missing_read_ids = sorted(set([o.a_read_id for o in overlaps] + [o.b_read_id for o in overlaps])
+                                  - set(labeled_reads.keys()))
+        if len(missing_read_ids) > 0:
+            logger.warning(f"{len(missing_read_ids)} reads are not finished "
+                           f"(rerun with `resume=True`): {missing_read_ids}")
         save_pickle(labeled_reads, self.out_fname)
 
 
-def calc_repr_units(units, ward_threshold):
-    """Calculate representative units using hierarchical clustering."""
-    c = ClusteringSeq(units, revcomp=False, cyclic=True)
-    c.calc_dist_mat()
-    c.cluster_hierarchical(threshold=ward_threshold)
-    c.generate_consensus()
-    return {df["cluster_id"]: df["sequence"] for i, df in c.cons_seqs.iterrows()}
+def read_seed_sequence(seed, read_id):
+    """Seed of the random numbers specific to the read <read_id> derived from a base seed <seed>;
+    same as `SeedSequence(seed).spawn(n)[read_id]`."""
+    return np.random.SeedSequence(seed, spawn_key=(() if read_id is None else (read_id,)))
+
+
+def calc_repr_units(units, ward_threshold, max_n_units=1000, max_diff=0.1, seed=0, cons_engine="consed"):
+    """Calculate representative units using hierarchical clustering.
+    With <cons_engine> other than "consed", the consensus of each cluster is computed after rotating the units
+    to the phase of the unit with median length.
+
+    If there are more than <max_n_units> units, only <max_n_units> units randomly sampled with <seed>
+    (an int or a `np.random.SeedSequence`) are clustered to avoid the all-vs-all alignment of all the units.
+    The other units are compared with the representative units of the sample, and those with no
+    representative unit within <max_diff> are clustered recursively to add representative units.
+    """
+    if len(units) <= max_n_units:
+        c = ClusteringSeq(units, revcomp=False, cyclic=True)
+        c.calc_dist_mat()
+        c.cluster_hierarchical(threshold=ward_threshold)
+        if cons_engine == "consed":
+            c.generate_consensus()
+            return {df["cluster_id"]: df["sequence"] for i, df in c.cons_seqs.iterrows()}
+        repr_units = {}
+        for cluster_id in np.unique(c.assignment):
+            cluster_units = sorted([unit for unit, assignment in zip(units, c.assignment)
+                                    if assignment == cluster_id], key=len)
+            seed_unit = cluster_units[len(cluster_units) // 2]
+            repr_units[cluster_id] = consensus([seed_unit] + [rotate_to_seed(unit, seed_unit)
+                                                              for unit in cluster_units if unit is not seed_unit],
+                                               engine=cons_engine, seed_choice="original", n_iter=3)
+        return repr_units
+
+    rng = np.random.default_rng(seed)
+    is_sampled = np.zeros(len(units), dtype=bool)
+    is_sampled[rng.choice(len(units), max_n_units, replace=False)] = True
+    repr_units = calc_repr_units([unit for unit, sampled in zip(units, is_sampled) if sampled],
+                                 ward_threshold, max_n_units, max_diff, seed, cons_engine)
+    logger.debug(f"{len(repr_units)} representative units from {max_n_units}/{len(units)} sampled units")
+
+    # Units not represented by the sample
+    er = EdlibRunner("global", revcomp=False, cyclic=True)
+    outlier_units = [unit for unit, sampled in zip(units, is_sampled)
+                     if not sampled and all(er.align(unit, repr_unit).diff > max_diff
+                                            for repr_unit in repr_units.values())]
+    if len(outlier_units) > 0:
+        logger.debug(f"Cluster {len(outlier_units)} units far from the representative units")
+        repr_id_offset = max(repr_units.keys()) + 1
+        for repr_id, repr_unit in calc_repr_units(outlier_units, ward_threshold,
+                                                  max_n_units, max_diff, seed, cons_engine).items():
+            repr_units[repr_id_offset + repr_id] = repr_unit
+    return repr_units
+
+
+swap_indel = str.maketrans("ID", "DI")
+
+
+def best_boundary(up_seq, down_seq):
+    """Find the boundary position `x` on the overlap of two units maximizing the total number of
+    matches in `up_seq[:x] + down_seq[x:]`, given the flattened CIGARs of the upper and lower units
+    on the overlap. Among the best positions, the first one is taken and then a later one is taken
+    over if `up_seq[x - 1] > down_seq[x - 1]`. Return value is `(max_pos, max_score)`.
+    """
+    up = np.frombuffer(up_seq.encode(), dtype=np.uint8)
+    down = np.frombuffer(down_seq.encode(), dtype=np.uint8)
+    scores = (np.concatenate([[0], np.cumsum(up == ord('='))])
+              + np.concatenate([np.cumsum((down == ord('='))[::-1])[::-1], [0]]))
+    max_pos = int(np.argmax(scores))
+    max_score = int(scores[max_pos])
+    later_poss = np.where((scores[max_pos + 1:] == max_score) & (up[max_pos:] > down[max_pos:]))[0]
+    if len(later_poss) > 0:
+        max_pos += 1 + int(later_poss[-1])
+    return (max_pos, max_score)
 
 
 def calc_sync_units(read, map_threshold):
     """Compute synchronized units by mapping the representative units to the read iteratively."""
     er = EdlibRunner("glocal", revcomp=False, cyclic=False)
     sync_units = []
-    read_seq = read.seq
+    read_seq = bytearray(read.seq, "ascii")
+    # Best mapping of each representative unit to the (masked) read
+    mappings = {repr_id: er.align(repr_unit, read.seq)
+                for repr_id, repr_unit in sorted(read.repr_units.items())}
+    count("edlib_calls", len(mappings))
     while True:
-        mappings = [(er.align(repr_unit, read_seq), repr_id)
-                    for repr_id, repr_unit in sorted(read.repr_units.items())]
-        diffs = [mapping.diff for mapping, repr_id in mappings]
-        if np.min(diffs) >= map_threshold:
+        repr_id = min(mappings, key=lambda repr_id: mappings[repr_id].diff)
+        mapping = mappings[repr_id]
+        if mapping.diff >= map_threshold:
             break
-        mapping, repr_id = mappings[np.argmin(diffs)]
 
         flatten_cigar = mapping.cigar.flatten().string
 
@@ -123,24 +231,44 @@ def calc_sync_units(read, map_threshold):
             insert_len = 0   # start side
             while flatten_cigar[insert_len] == 'I':
                 insert_len += 1
-            while insert_len > 0 and start > 0:
-                start -= 1
-                insert_len -= 1
+            start_ext = min(insert_len, start)
+            start -= start_ext
+            start_insert_len = insert_len
             insert_len = 0   # end side
             while flatten_cigar[-1 - insert_len] == 'I':
                 insert_len += 1
-            while insert_len > 0 and end < read.length:
-                end += 1
-                insert_len -= 1
+            end_ext = min(insert_len, read.length - end)
+            end += end_ext
+            end_insert_len = insert_len
 
-            sync_units.append(TRUnit(start, end, repr_id=repr_id, strand=0))
+            # CIGAR of the unit sequence (as query) against the representative unit (as target)
+            unit_cigar = flatten_cigar.translate(swap_indel)
+            unit_cigar = (unit_cigar[:start_insert_len - start_ext]
+                          + 'X' * start_ext
+                          + unit_cigar[start_insert_len:len(unit_cigar) - end_insert_len]
+                          + 'X' * end_ext
+                          + unit_cigar[len(unit_cigar) - end_insert_len + end_ext:])
+
+            sync_units.append((TRUnit(start, end, repr_id=repr_id, strand=0), unit_cigar))
 
         # Mask middle half sequence of the mapped region
         left = int(start + (end - start) / 4)
         right = int(end - (end - start) / 4)
-        read_seq = read_seq[:left] + ('N' * (right - left)) + read_seq[right:]
-
-    sync_units.sort(key=lambda x: x.start)
+        read_seq[left:right] = b'N' * (right - left)
+
+        # Masking never improves mappings, so re-map only the representative units
+        # whose best mapping is overlapping to the masked region
+        masked_seq = None
+        for masked_id, masked_mapping in mappings.items():
+            if masked_mapping.t_start < right and left < masked_mapping.t_end:
+                if masked_seq is None:
+                    masked_seq = read_seq.decode("ascii")
+                mappings[masked_id] = er.align(read.repr_units[masked_id], masked_seq)
+                count("edlib_calls")
+
+    sync_units.sort(key=lambda x: x[0].start)
+    sync_units, unit_cigars = [unit for unit, unit_cigar in sync_units], \
+        [unit_cigar for unit, unit_cigar in sync_units]
 
     # Resolve the conflict on the overlapping mapped regions
     er = EdlibRunner("global", revcomp=False, cyclic=False)
@@ -151,37 +279,23 @@ def calc_sync_units(read, map_threshold):
             logger.debug(
                 f"conflict {sync_units[i]} and {sync_units[j]} ({overlap_len} bp)")
 
-            # Cut out the overlapping sequeces from both units
-            unit_seq = read.seq[sync_units[i].start:sync_units[i].end]
-            alignment = er.align(
-                unit_seq, read.repr_units[sync_units[i].repr_id])
-            # from unit of upper side
-            up_seq = alignment.cigar.flatten().string[-overlap_len:]
-
-            unit_seq = read.seq[sync_units[j].start:sync_units[j].end]
-            alignment = er.align(
-                unit_seq, read.repr_units[sync_units[j].repr_id])
-            # from unit of down side
-            down_seq = alignment.cigar.flatten().string[:overlap_len]
+            # Cut out the overlapping sequeces from both units, using the alignments of the mappings
+            up_seq = unit_cigars[i][-overlap_len:].rjust(overlap_len)   # from unit of upper side
+            down_seq = unit_cigars[j][:overlap_len].ljust(overlap_len)   # from unit of down side
 
             logger.debug(up_seq)
             logger.debug(down_seq)
 
             # Calculate the position where the total number of matches is maximized
-            max_pos = 0
-            max_score = 0
-            for x in range(overlap_len + 1):
-                score = Counter(up_seq[:x])['='] + Counter(down_seq[x:])['=']
-                if (max_score < score) or (max_score == score and up_seq[x - 1] > down_seq[x - 1]):
-                    max_score = score
-                    max_pos = x
+            max_pos, max_score = best_boundary(up_seq, down_seq)
             logger.debug(f"max pos {max_pos}, max score {max_score}")
 
             # Redefine the boundaries as the best position
-            sync_units[i].end -= (overlap_len - x)
-            sync_units[j].start += x
+            sync_units[i].end -= (overlap_len - max_pos)
+            sync_units[j].start += max_pos
 
     # Filter units after resolving conflict; because mapping is now changed
+    count("edlib_calls", len(sync_units))
     sync_units = list(filter(lambda unit: er.align(read.seq[unit.start:unit.end],
                                                    read.repr_units[unit.repr_id]).diff < map_threshold,
                              sync_units))
@@ -189,16 +303,19 @@ def calc_sync_units(read, map_threshold):
     return sync_units
 
 
-def synchronize_reads(overlaps, target_read_id, centromere_reads_by_id,
-                      ward_threshold=0.15, map_threshold=0.1):
-    # List up reads overlapping to `target_read_id`
+def list_involved_reads(overlaps, target_read_id):
+    """List up `(read_id, strand)` of the reads overlapping to `target_read_id` (and itself)."""
     involved_reads = set([(target_read_id, 0)])
     for o in overlaps:
         if o.a_read_id == target_read_id:
             involved_reads.add((o.b_read_id, o.strand))
         elif o.b_read_id == target_read_id:
             involved_reads.add((o.a_read_id, o.strand))
+    return involved_reads
+
 
+def _synchronize_reads(involved_reads, centromere_reads_by_id, ward_threshold, map_threshold,
+                       max_n_units, cons_engine, seed):
     reads = [deepcopy(centromere_reads_by_id[read_id] if strand == 0
                       else revcomp_read(centromere_reads_by_id[read_id]))
              for read_id, strand in involved_reads]
@@ -206,94 +323,146 @@ def synchronize_reads(overlaps, target_read_id, centromere_reads_by_id,
     logger.info(f"Reads: {involved_reads}")
 
     # Compute representative units (just for phase synchronization) within the overlap
-    repr_units = calc_repr_units([unit_seq for read in reads for unit_seq in read.unit_seqs],
-                                 ward_threshold=ward_threshold)
+    with timer("repr_units"):
+        repr_units = calc_repr_units([unit_seq for read in reads for unit_seq in read.unit_seqs],
+                                     ward_threshold=ward_threshold,
+                                     max_n_units=max_n_units,
+                                     max_diff=map_threshold,
+                                     seed=seed,
+                                     cons_engine=cons_engine)
 
     # Synchronize the units involved in the overlap
-    for read in reads:
-        read.repr_units = repr_units
-        read.units = calc_sync_units(read, map_threshold=map_threshold)
-        read.synchronized = True
+    with timer("sync_units"):
+        for read in reads:
+            read.repr_units = repr_units
+            read.units = calc_sync_units(read, map_threshold=map_threshold)
+            read.synchronized = True
 
     return reads
 
 
-class PairwiseAlignment:
-    def __init__(self, a_seq, b_seq):
-        er = EdlibRunner("global", revcomp=False, cyclic=False)
-        self.fcigar = er.align(b_seq.lower(), a_seq.lower(
-        )).cigar.flatten().string   # NOTE: b vs a; be careful!
-        self.source, self.target = '', ''
-        s_pos, t_pos = 0, 0
-        for c in self.fcigar:
-            if c == '=' or c == 'X':
-                self.source += a_seq[s_pos]
-                self.target += b_seq[t_pos]
-                s_pos += 1
-                t_pos += 1
-            elif c == 'I':
-                self.source += '-'
-                self.target += b_seq[t_pos]
-                t_pos += 1
-            else:
-                self.source += a_seq[s_pos]
-                self.target += '-'
-                s_pos += 1
-
-    def show(self, by_cigar=False):
-        if by_cigar:   # standard alignment like BLAST
-            print(self.source)
-            print(self.fcigar)
-            print(self.target)
-        else:
-            print(''.join([' ' if c == '=' else self.source[i]
-                           for i, c in enumerate(self.fcigar)]))
-            print(''.join([self.source[i] if c ==
-                           '=' else ' ' for i, c in enumerate(self.fcigar)]))
-            print(''.join([' ' if c == '=' else self.target[i]
-                           for i, c in enumerate(self.fcigar)]))
-
-
-def count_variants(cluster_cons_unit, cluster_units):
-    """Given a set of unit sequences <units> in a cluster, calculate the composition of
-    nucleotides including '-' (= distribution of each )
-    for each position on <cluster_cons_unit> as a seed.
-    from which <units> are generated, compute the variations (= nucleotides inconsistent between
-    <units> and <cluster_cons_unit> and their relative frequency).
-    Since a cluster should be homogeneous (i.e., mono-source), the relative frequencies are
-    expected to be not much larger than sequencing error.
+def synchronize_reads(overlaps, target_read_id, centromere_reads_by_id,
+                      ward_threshold=0.15, map_threshold=0.1, max_n_units=1000, cons_engine="consed", seed=0):
+    return _synchronize_reads(list_involved_reads(overlaps, target_read_id),
+                              centromere_reads_by_id, ward_threshold, map_threshold, max_n_units, cons_engine,
+                              read_seed_sequence(seed, target_read_id))
+
+
+def revcomp_sync_read(read, repr_units_rc):
+    """Reverse complement of a synchronized read whose units are kept forward by
+    using the reverse complement of the representative units `repr_units_rc`."""
+    read = revcomp_read(read)
+    read.repr_units = repr_units_rc
+    for unit in read.units:
+        unit.strand = 0
+    return read
+
+
+def group_target_reads(read_ids, overlaps, sync_group_size):
+    """Greedily group each target read in `read_ids` with at most `sync_group_size - 1` other
+    target reads overlapping to it, in the order of `read_ids`."""
+    if sync_group_size <= 1:
+        return [[read_id] for read_id in read_ids]
+
+    target_read_ids = set(read_ids)
+    neighbors = defaultdict(set)
+    for o in overlaps:
+        if o.a_read_id in target_read_ids and o.b_read_id in target_read_ids:
+            neighbors[o.a_read_id].add(o.b_read_id)
+            neighbors[o.b_read_id].add(o.a_read_id)
+
+    groups = []
+    grouped_read_ids = set()
+    for read_id in read_ids:
+        if read_id in grouped_read_ids:
+            continue
+        group = [read_id]
+        for neighbor_id in sorted(neighbors[read_id]):
+            if len(group) >= sync_group_size:
+                break
+            if neighbor_id not in grouped_read_ids:
+                group.append(neighbor_id)
+        grouped_read_ids.update(group)
+        groups.append(group)
+    return groups
+
+
+def synchronize_read_group(overlaps, target_read_ids, centromere_reads_by_id,
+                           ward_threshold=0.15, map_threshold=0.1, max_n_units=1000,
+                           cons_engine="consed", seed=0):
+    """Synchronize the union of the reads overlapping to any of `target_read_ids` at once, and
+    derive the same output as `synchronize_reads` for each target read from it.
+    Return value is `{target_read_id: sync_reads}`.
+
+    The reads are oriented consistently with the first target read. Target reads whose overlaps
+    are inconsistent with the orientation are synchronized separately.
+    Random numbers are derived from <seed> for the first target read, or for each target read
+    synchronized separately.
     """
-    assert cluster_cons_unit != "", "Empty strings are not allowed"
-    # TODO: how to decide "same variant?" especially for multiple variations on same position (but slightly different among units)?
-    variants = Counter()
-    for unit in cluster_units:
-        assert unit != "", "Empty strings are not allowed"
-        # alignment.fcigar(cluster_cons_unit) = unit
-        alignment = PairwiseAlignment(cluster_cons_unit, unit)
-        tpos = 0
-        var_index = 0   # positive values for continuous insertions
-        for i, c in enumerate(alignment.fcigar):
-            if c == '=':
-                var_index = 0
-            elif c == 'I':
-                var_index += 1
-            if c != '=':
-                # TODO: multiple D on the same pos are aggregated
-                variants[(tpos, var_index, c, alignment.target[i])] += 1
-            if c != 'I':
-                tpos += 1
-        assert tpos == len(cluster_cons_unit)
-    return variants
+    involved_reads = {target_read_id: list_involved_reads(overlaps, target_read_id)
+                      for target_read_id in target_read_ids}
+
+    # Orient the reads by traversing the overlaps from the first target read
+    orients = {target_read_ids[0]: 0}
+    queue = [target_read_ids[0]]
+    while len(queue) > 0:
+        read_id = queue.pop(0)
+        for involved_read_id, strand in involved_reads.get(read_id, ()):
+            if involved_read_id not in orients:
+                orients[involved_read_id] = orients[read_id] ^ strand
+                queue.append(involved_read_id)
+
+    sync_reads_by_target = {}
+    consistent_read_ids = []
+    for target_read_id in target_read_ids:
+        if (target_read_id in orients
+                and all([orients.get(read_id) == orients[target_read_id] ^ strand
+                         for read_id, strand in involved_reads[target_read_id]])):
+            consistent_read_ids.append(target_read_id)
+        else:
+            logger.debug(f"Read {target_read_id}: inconsistent orientation. Synchronize separately.")
+            sync_reads_by_target[target_read_id] = \
+                _synchronize_reads(involved_reads[target_read_id],
+                                   centromere_reads_by_id, ward_threshold, map_threshold,
+                                   max_n_units, cons_engine, read_seed_sequence(seed, target_read_id))
+    if len(consistent_read_ids) == 0:
+        return sync_reads_by_target
+
+    group_reads = set([(read_id, orients[read_id])
+                       for target_read_id in consistent_read_ids
+                       for read_id, strand in involved_reads[target_read_id]])
+    sync_reads_by_id = {read.id: read
+                        for read in _synchronize_reads(group_reads, centromere_reads_by_id,
+                                                       ward_threshold, map_threshold, max_n_units, cons_engine,
+                                                       read_seed_sequence(seed, target_read_ids[0]))}
+
+    repr_units_rc = {repr_id: revcomp_seq(repr_unit)
+                     for repr_id, repr_unit in next(iter(sync_reads_by_id.values())).repr_units.items()}
+    for target_read_id in consistent_read_ids:
+        sync_reads_by_target[target_read_id] = \
+            [(sync_reads_by_id[read_id] if orients[target_read_id] == 0
+              else revcomp_sync_read(sync_reads_by_id[read_id], repr_units_rc))
+             for read_id, strand in involved_reads[target_read_id]]
+    return sync_reads_by_target
 
 
 def list_variations(template_unit, cluster_cons_unit):
-    """Single-vs-single version of count_variants().
+    """Single-vs-single version of `pileup.list_variants`.
     That is, list up the differences between the (imaginary) template unit and the consensus unit
     of a cluster (which should be a real instance).
-    The return value is [(position_on_template_unit, variant_type, base_on_cluster_cons_unit)].
+    The return value is [(position_on_template_unit, index, variant_type, base_on_cluster_cons_unit)].
     """
     assert template_unit != "" and cluster_cons_unit != "", "Empty strings are not allowed"
-    return list(count_variants(template_unit, [cluster_cons_unit]).keys())
+    return [variant for variant, count in list_variants(template_unit, pileup(template_unit, [cluster_cons_unit]))]
+
+
+# Lookup tables of log probabilities for each QV (and for each pair of QVs)
+max_qv = 93
+log10_p_correct_table = np.array([phred_to_log10_p_correct(qv) for qv in range(max_qv + 1)])
+log10_p_error_table = np.array([phred_to_log10_p_error(qv) for qv in range(max_qv + 1)])
+log10_p_pair_match_table = log10_p_correct_table[:, None] + log10_p_correct_table[None, :]
+with np.errstate(divide="ignore"):
+    log10_p_pair_non_match_table = np.log10(1 - np.power(10, log10_p_pair_match_table))
 
 
 def log_prob_gen(cons_unit, obs_unit, obs_qual=None, p_non_match=0.01):
@@ -307,6 +476,7 @@ def log_prob_gen(cons_unit, obs_unit, obs_qual=None, p_non_match=0.01):
     # Compute alignment
     er = EdlibRunner("global", revcomp=False)
     fcigar = er.align(cons_unit, obs_unit).cigar.flatten().string
+    count("edlib_calls")
     # logger.debug(fcigar)
 
     # Calculate the sum of log probabilities for each position in the alignment
@@ -315,15 +485,10 @@ def log_prob_gen(cons_unit, obs_unit, obs_qual=None, p_non_match=0.01):
         n_non_match = len(fcigar) - n_match
         return n_match * np.log10(1 - p_non_match) + n_non_match * np.log10(p_non_match)
     else:
-        p = 0.
-        pos = 0
-        for c in fcigar:
-            p += (phred_to_log10_p_correct(obs_qual[pos]) if c == '='
-                  else phred_to_log10_p_error(obs_qual[pos]))
-            if c in ('=', 'X', 'D'):
-                pos += 1
-        assert pos == len(obs_unit) == len(obs_qual), "Invalid length"
-        return p
+        ops, pos = fcigar_positions(fcigar, "=XD")
+        assert pos[-1] + (ops[-1] != ord('I')) == len(obs_unit) == len(obs_qual), "Invalid length"
+        qvs = np.minimum(np.asarray(obs_qual, dtype=np.int64), max_qv)[np.minimum(pos, len(obs_qual) - 1)]
+        return np.sum(np.where(ops == ord('='), log10_p_correct_table[qvs], log10_p_error_table[qvs]))
 
 
 def log_prob_align(unit_x, unit_y, qual_x=None, qual_y=None, p_error=0.01):
@@ -334,6 +499,7 @@ def log_prob_align(unit_x, unit_y, qual_x=None, qual_y=None, p_error=0.01):
     # Compute alignment
     er = EdlibRunner("global", revcomp=False)
     fcigar = er.align(unit_x, unit_y).cigar.flatten().string
+    count("edlib_calls")
     # logger.debug(fcigar)
 
     # Calculate the sum of log probabilities for each position in the alignment
@@ -343,24 +509,30 @@ def log_prob_align(unit_x, unit_y, qual_x=None, qual_y=None, p_error=0.01):
         n_non_match = len(fcigar) - n_match
         return n_match * np.log10(p_match) + n_non_match * np.log10(1 - p_match)
     else:
-        p = 0.
-        pos_x = pos_y = 0
-        for c in fcigar:   # fcigar(unit_y) = unit_x
-            p_match = phred_to_log10_p_correct(
-                qual_x[pos_x]) + phred_to_log10_p_correct(qual_y[pos_y])
-            p += (p_match if c == '='
-                  else np.log10(1 - np.power(10, p_match)))
-            if c in ('=', 'X', 'I'):
-                pos_x += 1
-            if c in ('=', 'X', 'D'):
-                pos_y += 1
-        assert pos_x == len(unit_x) == len(qual_x) and pos_y == len(
-            unit_y) == len(qual_y), "Invalid length"
-        return p
+        # fcigar(unit_y) = unit_x
+        ops, pos_x = fcigar_positions(fcigar, "=XI")
+        _, pos_y = fcigar_positions(fcigar, "=XD")
+        assert (pos_x[-1] + (ops[-1] != ord('D')) == len(unit_x) == len(qual_x)
+                and pos_y[-1] + (ops[-1] != ord('I')) == len(unit_y) == len(qual_y)), "Invalid length"
+        qvs_x = np.minimum(np.asarray(qual_x, dtype=np.int64), max_qv)[np.minimum(pos_x, len(qual_x) - 1)]
+        qvs_y = np.minimum(np.asarray(qual_y, dtype=np.int64), max_qv)[np.minimum(pos_y, len(qual_y) - 1)]
+        return np.sum(np.where(ops == ord('='),
+                               log10_p_pair_match_table[qvs_x, qvs_y],
+                               log10_p_pair_non_match_table[qvs_x, qvs_y]))
+
+
+# Cumulative table of log10(n!), which is extended on demand
+log_factorial_table = np.zeros(1)
 
 
 def log_factorial(n):
-    return np.sum([np.log10(i) for i in range(1, n + 1)])
+    """Return log10(n!), where 0 is returned for n <= 0. <n> can be an array of integers."""
+    global log_factorial_table
+    n = np.maximum(n, 0)
+    max_n = np.max(n, initial=0)
+    if max_n >= len(log_factorial_table):
+        log_factorial_table = np.concatenate([[0.], np.cumsum(np.log10(np.arange(1, 2 * max_n + 1)))])
+    return log_factorial_table[n]
 
 
 # TODO: use positional QVs
@@ -370,45 +542,30 @@ def log_prob_composition(cons_unit, obs_units, p_error=0.001):
     Concretely, compute Multinomial(n_A, ..., n_-; p_A, ..., p_-) for each position, where p_X = 1 - p_error
     if X is the base of <cons_unit>, otherwise p_X = p_error.
     """
-    var_counts = count_variants(cons_unit, obs_units)
-    var_pos = [pos for pos, index, op, base in var_counts.keys()]
-
-    # compute for matches
-    n_matches = len(cons_unit) - len(set(var_pos))
-    p_match = n_matches * len(obs_units) * np.log10(1 - p_error)
-
-    # compute for variants
-    # {(pos, index): Counter('A': n_A, ..., '-': n_-)} for each variant column
-    var_freqs = defaultdict(Counter)
-    # list up frequencies of each variant for each position
-    for (pos, index, op, base), count in var_counts.items():
-        var_freqs[(pos, index)][base] = count
-    log_factorial_N = log_factorial(len(obs_units))
-    p_var = 0.
-    for key, counts in var_freqs.items():   # for each variant position
-        p_var += log_factorial_N
-        for base, count in counts.items():
-            p_var -= log_factorial(count)
-            p_var += count * np.log10(p_error)
-        # number of units having base same as seed
-        n_match = len(obs_units) - np.sum(list(counts.values()))
-        p_var -= log_factorial(n_match)
-        p_var += n_match * np.log10(1 - p_error)
-
-    return p_match + p_var
+    return log_prob_pileup(cons_unit, pileup(cons_unit, obs_units), p_error)
+
+
+def log_prob_pileup(seed, counts, p_error=0.001):
+    """Compute `log_prob_composition` from the count tensor <counts> of the pileup on <seed>.
+    The columns are those of the bases of <seed> and the insertion columns having any insertion."""
+    is_column = np.zeros(counts.shape[:2], dtype=bool)
+    is_column[:len(seed), 0] = True
+    is_column[:, 1:] = np.sum(counts[:, 1:, :gap_code], axis=2) > 0
+    column_counts = counts[is_column]
+    n = np.sum(column_counts, axis=1)
+    n_seed = np.take_along_axis(column_counts, seed_codes(seed, counts)[is_column][:, None].astype(np.int64),
+                                axis=1)[:, 0]
+    return (np.sum(log_factorial(n)) - np.sum(log_factorial(column_counts))
+            + np.sum(n_seed) * np.log10(1 - p_error) + np.sum(n - n_seed) * np.log10(p_error))
 
 
 def normalize_assignments(assignments):
     """Convert a clustering state <assignments> so that all essentially equal states can be
     same array. Return value type is Tuple so that it can be hashed as a dict key.
     """
-    convert_table = {}
-    new_id = 0
-    for cluster_id in assignments:
-        if cluster_id not in convert_table:
-            convert_table[cluster_id] = new_id
-            new_id += 1
-    return tuple([convert_table[cluster_id] for cluster_id in assignments])
+    # Cluster IDs are renumbered in the order of their first appearance
+    _, first_index, inverse = np.unique(assignments, return_index=True, return_inverse=True)
+    return tuple(np.argsort(np.argsort(first_index))[inverse.ravel()].tolist())
 
 
 @dataclass(eq=False)
@@ -417,31 +574,77 @@ class SplitMergeClustering:
     quals: np.ndarray
     alpha: float
     read_id: int
+    cons_cache_size: int = 10000
+    columns_cache_size: int = 50
+    gen_cache_size: int = 100
+    align_cache_size: int = 100
+    cluster_cache_size: int = 1000
+    loo_approx: bool = True
+    use_quals: bool = True
+    cons_engine: str = "consed"
+    seed: int = 0
+    split_init: str = "sequential"
 
     def __post_init__(self):
+        assert self.split_init in ("sequential", "random"), "Invalid `split_init`"
         self.N = len(self.units)   # number of data
+        self._assignments = None
         self.assignments = np.zeros(
             [self.N], dtype=np.int16)   # cluster assignments
 
-        # Compute all-vs-all unit alignment likelihood
-        #self.log_p_mat = np.zeros([self.N, self.N], dtype=np.float32)
-        # for i in range(self.N):
-        #    for j in range(i + 1, self.N):
-        #        self.log_p_mat[i][j] = self.log_p_mat[j][i] = log_prob_align(self.units[i], self.units[j],
-        #                                                                    self.quals[i], self.quals[j])
+        # Unit alignment likelihoods are computed only for the anchor units of split proposals
+        self.log_p_align_rows = OrderedDict()   # {unit_id: log_prob_align(units[i], units[unit_id]) for each i (NaN if not computed)}; LRU
 
         # Cache for values computationally expensive
         self.cache_log_prob_clustering = {}   # {normalized_assignments: probability}
-        self.cache_cluster_cons = {}   # {unit_ids: cluster_cons}
+        self.cache_log_prob_cluster = OrderedDict()   # {frozenset(unit_ids): probability}; LRU
+        self.cache_cluster_cons = OrderedDict()   # {frozenset(unit_ids): cluster_cons}; LRU
+        self.cache_cluster_columns = OrderedDict()   # {frozenset(unit_ids): (counts, unit_columns)}; LRU, small because large
+        self.cache_log_prob_gen = OrderedDict()   # {cons: log_prob_gen(cons, units[i]) for each i (NaN if not computed)}; LRU
+        self.n_consed_calls = 0
+        self.n_cons_cache_hits = 0   # number of Consed calls saved by the cache
+        self.n_cons_loo_approx = 0   # number of Consed calls saved by leave-one-out approximation
+
+        # Random number generator specific to the read
+        self.rng = np.random.default_rng(read_seed_sequence(self.seed, self.read_id))
 
         # Pre-compute some constants
-        self.const_ewens = -np.sum([np.log10(self.alpha + i)
-                                    for i in range(self.N)])
+        self.const_ewens = -np.sum(np.log10(self.alpha + np.arange(self.N)))
         self.const_gibbs = -np.log10(self.N - 1 + self.alpha)
 
         # Compute consensus unit of the whole units so that comparing clusters can be easy
         #self.template_unit = self.cluster_cons(0)
 
+    @property
+    def assignments(self):
+        """Current clustering state, which is read-only. Set a new array to change the state."""
+        return self._assignments
+
+    @assignments.setter
+    def assignments(self, assignments):
+        # Keep the members of each cluster, updating only the clusters changed from the current state
+        assignments = np.array(assignments)
+        assignments.flags.writeable = False
+        if self._assignments is None or len(self._assignments) != len(assignments):
+            changed_ids = np.unique(assignments)
+            self.cluster_members = {}   # {cluster_id: unit_ids}
+        else:
+            is_changed = assignments != self._assignments
+            changed_ids = np.unique(np.concatenate([self._assignments[is_changed], assignments[is_changed]]))
+        self._assignments = assignments
+        for cluster_id in changed_ids.tolist():
+            unit_ids = np.nonzero(assignments == cluster_id)[0]
+            unit_ids.flags.writeable = False
+            if len(unit_ids) > 0:
+                self.cluster_members[cluster_id] = unit_ids
+            else:
+                self.cluster_members.pop(cluster_id, None)
+        self.current_cluster_ids = np.array(sorted(self.cluster_members.keys()), dtype=assignments.dtype)
+        self.current_normalized_assignments = normalize_assignments(assignments)
+
+    def is_current(self, assignments):
+        return assignments is None or assignments is self._assignments
+
     def show_clustering(self):
         er = EdlibRunner("global", revcomp=False)
         for cluster_id in np.unique(self.assignments):
@@ -462,9 +665,10 @@ class SplitMergeClustering:
     def cluster_unit_ids(self, cluster_id, assignments=None, exclude_unit=None):
         """Return indices of the units belonging to the cluster <cluster_id> given a clustering state <assignments>,
         while excluding a unit <exclude_unit> if provided."""
-        if assignments is None:
-            assignments = self.assignments
-        unit_ids = np.where(assignments == cluster_id)[0]
+        if self.is_current(assignments):
+            unit_ids = self.cluster_members.get(int(cluster_id), np.zeros(0, dtype=np.int64))
+        else:
+            unit_ids = np.where(assignments == cluster_id)[0]
         if exclude_unit is not None:
             unit_ids = unit_ids[np.where(unit_ids != exclude_unit)]
         return unit_ids
@@ -476,135 +680,267 @@ class SplitMergeClustering:
 
     def n_clusters(self, assignments=None):
         """Return the number of clusters."""
-        return len(self.cluster_ids(self.assignments if assignments is None else assignments))
+        return len(self.cluster_ids(assignments))
 
     def cluster_ids(self, assignments=None):
         """Return a list of cluster indices."""
-        return np.unique(self.assignments if assignments is None else assignments)
+        return self.current_cluster_ids if self.is_current(assignments) else np.unique(assignments)
 
     def cluster_cons(self, cluster_id, assignments=None, exclude_unit=None):
         """Return the consensus sequence of the units belonging to the cluster <cluster_id> given a clustering state <assignments>,
         while excluding a unit <exclude_unit> if provided."""
-        # Check the cache
-        cluster_units = set(self.cluster_units(cluster_id, assignments))
-        excluded = False
-        if exclude_unit is None or exclude_unit not in cluster_units:
-            if tuple(sorted(cluster_units)) in self.cache_cluster_cons:
-                return self.cache_cluster_cons[tuple(sorted(cluster_units))]
-        else:
-            cluster_units.remove(exclude_unit)
-            excluded = True
-        cluster_units = sorted(cluster_units)
-
-        # cluster_units = self.cluster_units(cluster_id, assignments, exclude_unit)   # units belonging to the cluster
+        if exclude_unit is not None and self.loo_approx:
+            unit_ids = frozenset(self.cluster_unit_ids(cluster_id, assignments).tolist())
+            if exclude_unit in unit_ids and len(unit_ids) > 2:
+                return self.loo_cons(unit_ids, exclude_unit)
+        return self.units_cons(frozenset(self.cluster_unit_ids(cluster_id, assignments, exclude_unit).tolist()))
+
+    def units_cons(self, unit_ids):
+        """Return the consensus sequence of the units <unit_ids> <frozenset>."""
+        # Check the cache, where at most <cons_cache_size> least recently used sets of units are kept
+        if unit_ids in self.cache_cluster_cons:
+            self.cache_cluster_cons.move_to_end(unit_ids)
+            if len(unit_ids) > 1:
+                self.n_cons_cache_hits += 1
+            return self.cache_cluster_cons[unit_ids]
+
+        cluster_units = [self.units[i] for i in sorted(unit_ids)]
         if len(cluster_units) == 0:   # cluster with single unit which is excluded
             cons = ""
         elif len(cluster_units) == 1:   # cluster with single unit
             # TODO: NOTE: single data cluster can be harmful!
             cons = cluster_units[0]
         else:
-            cons = consed.consensus(cluster_units,
-                                    seed_choice="median",
-                                    error_msg=f"read {self.read_id}")
+            self.n_consed_calls += 1
+            with timer("consensus"):
+                cons = consensus(cluster_units,
+                                 engine=self.cons_engine,
+                                 seed_choice="median",
+                                 error_msg=f"read {self.read_id}")
+
+        self.cache_cluster_cons[unit_ids] = cons
+        if len(self.cache_cluster_cons) > self.cons_cache_size:
+            self.cache_cluster_cons.popitem(last=False)
+        return cons
 
-        if not excluded:
-            self.cache_cluster_cons[tuple(cluster_units)] = cons
+    def units_columns(self, unit_ids):
+        """Return the count tensor of the pileup of the units <unit_ids> on their consensus sequence
+        and the pileup cells of each unit, as a tuple of `(counts, {unit_id: columns})`.
+        Only <columns_cache_size> (or the number of the current clusters plus one, if larger) least recently
+        used sets of units are kept, since each entry holds arrays proportional to the total length of the units.
+        The latter keeps the columns of every cluster during a Gibbs sweep."""
+        if unit_ids in self.cache_cluster_columns:
+            self.cache_cluster_columns.move_to_end(unit_ids)
+            return self.cache_cluster_columns[unit_ids]
+
+        cons = self.units_cons(unit_ids)
+        unit_columns = {unit_id: align_columns(cons, self.units[unit_id]) for unit_id in unit_ids}
+        counts = pileup(cons, None, columns=list(unit_columns.values()))
+
+        self.cache_cluster_columns[unit_ids] = (counts, unit_columns)
+        while len(self.cache_cluster_columns) > max(self.columns_cache_size, self.n_clusters() + 1):
+            self.cache_cluster_columns.popitem(last=False)
+        return (counts, unit_columns)
+
+    def loo_cons(self, unit_ids, exclude_unit):
+        """Return the consensus sequence of the units <unit_ids> except <exclude_unit>.
+        Instead of calling Consed, the consensus of <unit_ids> is returned if removing the contribution of
+        <exclude_unit> from the pileup changes the majority vote of no column."""
+        loo_unit_ids = unit_ids - {exclude_unit}
+        if loo_unit_ids in self.cache_cluster_cons:
+            return self.units_cons(loo_unit_ids)
+        cons = self.units_cons(unit_ids)
+        if cons == "":
+            return self.units_cons(loo_unit_ids)
+
+        # The base of the consensus wins ties
+        counts, unit_columns = self.units_columns(unit_ids)
+        if not np.array_equal(majority_vote(counts, cons),
+                              majority_vote(remove_columns(counts, unit_columns[exclude_unit]), cons)):
+            return self.units_cons(loo_unit_ids)   # vote flipped
+
+        self.n_cons_loo_approx += 1
         return cons
 
     def log_prob_ewens(self, assignments=None):
         """Return the probability of partition."""
-        p = self.n_clusters() * np.log10(self.alpha)
+        p = self.n_clusters(assignments) * np.log10(self.alpha)
         for cluster_id in self.cluster_ids(assignments):
             p += log_factorial(self.n_units(cluster_id, assignments) - 1)
         return p + self.const_ewens
 
     def log_prob_cluster_composition(self, cluster_id, assignments=None, p_error=0.001):
         """Return log probability of the composition of the cluster <cluster_id> given a clustering state <assignments>"""
-        return log_prob_composition(self.cluster_cons(cluster_id, assignments),
-                                    self.cluster_units(cluster_id, assignments))
+        unit_ids = frozenset(self.cluster_unit_ids(cluster_id, assignments).tolist())
+        return log_prob_pileup(self.units_cons(unit_ids), self.units_columns(unit_ids)[0], p_error)
 
     def log_prob_units_generation(self, cluster_id, assignments=None):
         """Return log probability of generating the units belonging to a cluster <cluster_id> from the cluster
         given a clustering state <assignments>."""
-        cons = self.cluster_cons(cluster_id, assignments)
-        return np.sum([log_prob_gen(cons, unit) for unit in self.cluster_units(cluster_id, assignments)])
+        return np.sum(self.log_prob_gen_units(self.cluster_cons(cluster_id, assignments),
+                                              self.cluster_unit_ids(cluster_id, assignments)))
+
+    def unit_qual(self, unit_id):
+        """Return positional QVs of the unit <unit_id> if they are available and used."""
+        return self.quals[unit_id] if self.use_quals else None
+
+    def log_prob_gen_units(self, cons, unit_ids):
+        """Return log probabilities of generating the units <unit_ids> from a consensus sequence <cons>,
+        i.e., a column of the (units x consensus sequences) likelihood matrix. Only the entries not computed
+        yet for <cons> are computed.
+        The columns of at most <gen_cache_size> (or twice the number of the current clusters, if larger)
+        least recently used consensus sequences are kept."""
+        if cons in self.cache_log_prob_gen:
+            self.cache_log_prob_gen.move_to_end(cons)
+        else:
+            self.cache_log_prob_gen[cons] = np.full(self.N, np.nan)
+            while len(self.cache_log_prob_gen) > max(self.gen_cache_size, 2 * self.n_clusters()):
+                self.cache_log_prob_gen.popitem(last=False)
+        log_ps = self.cache_log_prob_gen[cons]
+        with timer("likelihood"):
+            for unit_id in np.asarray(unit_ids)[np.isnan(log_ps[unit_ids])]:
+                log_ps[unit_id] = log_prob_gen(cons, self.units[unit_id], self.unit_qual(unit_id))
+        return log_ps[unit_ids]
+
+    def log_prob_cluster(self, cluster_id, assignments=None):
+        """Return log probability of the composition of the cluster <cluster_id> and of generating its units
+        given a clustering state <assignments>. The value depends only on the units belonging to the cluster,
+        and therefore is cached by them for at most <cluster_cache_size> least recently used sets of units."""
+        unit_ids = frozenset(self.cluster_unit_ids(cluster_id, assignments).tolist())
+        if unit_ids in self.cache_log_prob_cluster:
+            self.cache_log_prob_cluster.move_to_end(unit_ids)
+            count("log_prob_cache_hits")
+            return self.cache_log_prob_cluster[unit_ids]
+
+        if self.cluster_cons(cluster_id, assignments) == "":   # Consed did not return
+            logger.warn(
+                f"No consensus @ read {self.read_id}, cluster {cluster_id}")
+            p = -np.inf
+        else:
+            p = (self.log_prob_cluster_composition(cluster_id, assignments)
+                 + self.log_prob_units_generation(cluster_id, assignments))
+        self.cache_log_prob_cluster[unit_ids] = p
+        if len(self.cache_log_prob_cluster) > self.cluster_cache_size:
+            self.cache_log_prob_cluster.popitem(last=False)
+        return p
+
+    def log_prob_clusters(self, cluster_ids, assignments=None):
+        """Return the sum of the terms of the joint probability which depend only on the clusters <cluster_ids>
+        (including their factors in the Ewens term) given a clustering state <assignments>.
+        The difference between two states which differ only in some clusters can be computed by this
+        function only for those clusters."""
+        p = 0.
+        for cluster_id in cluster_ids:
+            n_units = self.n_units(cluster_id, assignments)
+            if n_units == 0:
+                continue
+            p += (np.log10(self.alpha) + log_factorial(n_units - 1)
+                  + self.log_prob_cluster(cluster_id, assignments))
+        return p
 
     def log_prob_clustering(self, assignments=None):
         """Compute the joint probability of the current clustering state."""
         # Check the cache
-        normalized_assignments = normalize_assignments(
-            self.assignments if assignments is None else assignments)
+        normalized_assignments = (self.current_normalized_assignments if self.is_current(assignments)
+                                  else normalize_assignments(assignments))
         if normalized_assignments in self.cache_log_prob_clustering:
             #logger.debug(f"Found in cache")
+            count("log_prob_cache_hits")
             return self.cache_log_prob_clustering[normalized_assignments]
 
-        # First of all, check if consensus sequence exists for every cluster
-        for cluster_id in self.cluster_ids(assignments):
-            cons = self.cluster_cons(cluster_id, assignments)
-            if cons == "":   # Consed did not return
-                logger.warn(
-                    f"No consensus @ read {self.read_id}, cluster {cluster_id}")
-                return -np.inf
-
-        p_ewens = self.log_prob_ewens(assignments)
-        p_cluster_compositions = np.sum([self.log_prob_cluster_composition(cluster_id, assignments)
-                                         for cluster_id in self.cluster_ids(assignments)])
-        p_gen_units = np.sum([self.log_prob_units_generation(cluster_id, assignments)
-                              for cluster_id in self.cluster_ids(assignments)])
-
-        p = p_ewens + p_cluster_compositions + p_gen_units
+        p = self.const_ewens + self.log_prob_clusters(self.cluster_ids(assignments), assignments)
         self.cache_log_prob_clustering[normalized_assignments] = p
         return p
 
+    def log_prob_align_units(self, anchor_id, unit_ids):
+        """Return the alignment log likelihoods between the unit <anchor_id> and the units <unit_ids>,
+        i.e., a row of the (units x units) matrix which is filled lazily.
+        At most <align_cache_size> least recently used rows are kept."""
+        if anchor_id in self.log_p_align_rows:
+            self.log_p_align_rows.move_to_end(anchor_id)
+        else:
+            log_ps = np.full(self.N, np.nan)
+            for unit_id, row in self.log_p_align_rows.items():   # symmetric
+                log_ps[unit_id] = row[anchor_id]
+            self.log_p_align_rows[anchor_id] = log_ps
+            if len(self.log_p_align_rows) > self.align_cache_size:
+                self.log_p_align_rows.popitem(last=False)
+        log_ps = self.log_p_align_rows[anchor_id]
+        with timer("likelihood"):
+            for unit_id in np.asarray(unit_ids)[np.isnan(log_ps[unit_ids])]:
+                log_ps[unit_id] = log_prob_align(self.units[unit_id], self.units[anchor_id],
+                                                 self.unit_qual(unit_id), self.unit_qual(anchor_id))
+                if unit_id in self.log_p_align_rows:   # symmetric
+                    self.log_p_align_rows[unit_id][anchor_id] = log_ps[unit_id]
+        return log_ps[unit_ids]
+
+    def sequential_split(self, x, y, unit_ids):
+        """Split the units <unit_ids> into those with <x> and those with <y> by sequential allocation
+        [Dahl, 2005] in a random order, where each unit joins one of the two groups with probability
+        proportional to the size of the group times the alignment likelihood with the anchor unit.
+        Return a boolean array indicating the units joining <y>."""
+        unit_ids = np.asarray(unit_ids)
+        log_p_x = self.log_prob_align_units(x, unit_ids)
+        log_p_y = self.log_prob_align_units(y, unit_ids)
+        to_y = np.zeros(len(unit_ids), dtype=bool)
+        n_x, n_y = 1, 1
+        for i in self.rng.permutation(len(unit_ids)):
+            log_odds = (np.log10(n_y) + log_p_y[i]) - (np.log10(n_x) + log_p_x[i])
+            to_y[i] = self.rng.random() < 1 / (1 + np.power(10., -np.clip(log_odds, -300, 300)))
+            if to_y[i]:
+                n_y += 1
+            else:
+                n_x += 1
+        return to_y
+
     def gibbs_sampling_single(self, unit_id, cluster_ids, assignments):
         """Compute probability of the unit assignment for each cluster while excluding the unit."""
-        # NOTE: here assignment to a new cluster is not considered because of its very low probability
-        # weights = tuple(map(lambda log_p: np.power(10, log_p),
-        #                    [(np.log10(self.n_units(cluster_id, assignments, exclude_unit=unit_id))
-        #                      - np.log10(self.N - 1 + self.alpha)
-        #                      + log_prob_gen(self.cluster_cons(cluster_id, assignments, exclude_unit=unit_id),
-        #                                  self.units[unit_id]))
-        #                     for cluster_id in cluster_ids]))
-        # new_assignment = random.choices(cluster_ids, weights=weights)[0]   # sample a new cluster assignment based on the probabilities
-        #logger.debug(f"weights: {weights}, {assignments[unit_id]} -> {new_assignment}")
-        # return new_assignment
+        return self.gibbs_sampling_units([unit_id], cluster_ids, assignments)[0]
 
+    def gibbs_sampling_units(self, unit_ids, cluster_ids, assignments):
+        """Compute the new assignments of the units <unit_ids> to the clusters <cluster_ids> while excluding
+        each unit from its cluster, given a clustering state <assignments>.
+        The (units x clusters) matrix of the log probabilities is composed of the columns cached for each
+        consensus sequence, and only the entries for the clusters the units belong to are computed individually.
+        """
+        # NOTE: here assignment to a new cluster is not considered because of its very low probability
         # NOTE: below is a proxy of Gibbs sampling; deterministically decide the nearest cluster as assignment
-        max_prob = 0.
-        max_cluster_id = -1
-        #logger.debug(f"Unit {unit_id}")
-        for cluster_id in cluster_ids:
-            #logger.debug(f"Cluster {cluster_id}")
-            log_p = (np.log10(self.n_units(cluster_id, assignments, exclude_unit=unit_id))
-                     + self.const_gibbs
-                     + log_prob_gen(self.cluster_cons(cluster_id, assignments, exclude_unit=unit_id),
-                                    self.units[unit_id]))
-            p = np.power(10, log_p)
-            if p > max_prob:
-                max_prob = p
-                max_cluster_id = cluster_id
-        return max_cluster_id
+        unit_ids, cluster_ids = np.asarray(unit_ids), np.asarray(cluster_ids)
+        log_p_mat = np.array([self.log_prob_gen_units(self.cluster_cons(cluster_id, assignments), unit_ids)
+                              for cluster_id in cluster_ids]).T
+        n_units = np.array([self.n_units(cluster_id, assignments) for cluster_id in cluster_ids])
+
+        # Exclude each unit from the cluster it belongs to
+        is_own = assignments[unit_ids][:, None] == cluster_ids[None, :]
+        for i, j in zip(*np.nonzero(is_own)):
+            log_p_mat[i, j] = self.log_prob_gen_units(
+                self.cluster_cons(cluster_ids[j], assignments, exclude_unit=unit_ids[i]), [unit_ids[i]])[0]
+        with np.errstate(divide="ignore"):
+            log_p_mat += np.log10(n_units[None, :] - is_own) + self.const_gibbs
+
+        # Units having no possible cluster keep the current assignments
+        return np.where(np.max(log_p_mat, axis=1) == -np.inf,
+                        assignments[unit_ids],
+                        cluster_ids[np.argmax(log_p_mat, axis=1)])
 
     def gibbs_sampling(self, unit_ids, cluster_ids, assignments, n_iter=1):
         """Re-assign each unit of <unit_ids> into one of the clusters <cluster_ids>,
         Given a clustering state <assignments>.
+        In each iteration, all the units are re-assigned at once based on the state at the beginning of the
+        iteration, so that the assignments are a vectorized argmax over the likelihood matrix.
         """
+        unit_ids = np.asarray(unit_ids)
         for t in range(n_iter):
             #logger.debug(f"Round {t}")
-            for unit_id in unit_ids:
-                # logger.debug(assignments)
-                #old_assignment = assignments[unit_id]
-                assignments[unit_id] = self.gibbs_sampling_single(
-                    unit_id, cluster_ids, assignments)
-                #new_assignment = assignments[unit_id]
-                #logger.debug(f"Unit {unit_id}: {old_assignment} -> {new_assignment}")
+            assignments[unit_ids] = self.gibbs_sampling_units(unit_ids, cluster_ids, assignments)
         return assignments
 
     def do_gibbs(self, n_iter=2):
         """Run a single iteration of Gibbs sampling with all units."""
         p_old = self.log_prob_clustering()
-        self.assignments = self.gibbs_sampling(
-            list(range(self.N)), self.cluster_ids(), self.assignments, n_iter)
+        unit_ids, cluster_ids = np.arange(self.N), self.cluster_ids()
+        for t in range(n_iter):
+            self.assignments = self.gibbs_sampling_units(unit_ids, cluster_ids, self.assignments)
         p_new = self.log_prob_clustering()
         if p_old != -np.inf and p_new != -np.inf:
             logger.debug(f"State prob by Gibbs: {int(p_old)} -> {int(p_new)}")
@@ -612,25 +948,29 @@ class SplitMergeClustering:
             logger.debug(f"-inf @ {self.read_id}")
         # logger.debug(self.assignments)
 
-    def do_proposal(self, n_iter=30):
-        """Propose a new state by choosing random two units."""
+    def do_proposal(self, n_iter=30, deadline=None):
+        """Propose a new state by choosing random two units. Return the number of accepted proposals.
+        Proposals are stopped when `time.perf_counter()` exceeds <deadline> if given."""
         p_old = self.log_prob_clustering()
+        n_accepted = 0
         for t in range(n_iter):
+            if deadline is not None and time.perf_counter() > deadline:
+                break
             logger.debug(f"Proposal {t}/{n_iter}")
-            x, y = random.sample(list(range(self.N)), 2)
+            x, y = self.rng.choice(self.N, 2, replace=False)
             #logger.debug(f"Selected: {x}({self.assignments[x]}) and {y}({self.assignments[y]})")
             if self.assignments[x] == self.assignments[y]:
                 # logger.debug("Split")
-                self.propose_split(x, y)
+                n_accepted += self.propose_split(x, y)
             else:
-                pass
                 # logger.debug("Merge")
-                self.propose_merge(x, y)
+                n_accepted += self.propose_merge(x, y)
         p_new = self.log_prob_clustering()
         if p_old != -np.inf and p_new != -np.inf:
             logger.debug(f"State prob by split: {int(p_old)} -> {int(p_new)}")
         else:
             logger.debug(f"-inf @ {self.read_id}")
+        return n_accepted
 
     def propose_split(self, x, y, n_gibbs_iter=2):
         # Split cluster <old_cluster_id> into <old_cluster_id> and <new_cluster_id>
@@ -638,14 +978,15 @@ class SplitMergeClustering:
         new_cluster_id = np.max(self.assignments) + 1
         new_assignments = np.copy(self.assignments)
 
-        # Assign each unit to one of x and y randomly   # TODO: random assignment or sequential [Dahl]?
+        # Assign each unit to one of x and y sequentially or randomly
         new_assignments[y] = new_cluster_id
-        for i in range(self.N):
-            if i != x and i != y and new_assignments[i] == old_cluster_id:
-                new_assignments[i] = random.choice(
-                    (old_cluster_id, new_cluster_id))
-                # if self.log_p_mat[i][x] < self.log_p_mat[i][y]:
-                #    new_assignments[i] = new_cluster_id
+        is_target = new_assignments == old_cluster_id
+        is_target[x] = False
+        if self.split_init == "sequential":
+            to_y = self.sequential_split(x, y, np.nonzero(is_target)[0])
+        else:
+            to_y = self.rng.random(np.sum(is_target)) >= 0.5
+        new_assignments[is_target] = np.where(to_y, new_cluster_id, old_cluster_id)
         logger.debug(
             f"\nCurrent state:\n{self.assignments}\nProposed state (init):\n{new_assignments}")
 
@@ -656,57 +997,48 @@ class SplitMergeClustering:
         logger.debug(
             f"\nCurrent state:\n{self.assignments}\nProposed state (Gibbs):\n{new_assignments}")
 
-        # Compare the probability of the current state and the proposed state
-        p_current = self.log_prob_clustering()
-        p_new = self.log_prob_clustering(new_assignments)
+        # Compare the probability of the current state and the proposed state, only on the split clusters
+        p_current = self.log_prob_clusters((old_cluster_id,))
+        p_new = self.log_prob_clusters((old_cluster_id, new_cluster_id), new_assignments)
         logger.debug(
-            f"Current prob: {int(p_current)}, Proposed prob: {int(p_new)}")
+            f"Current prob: {p_current:.0f}, Proposed prob: {p_new:.0f} (split clusters only)")
         if p_current < p_new:
             # logger.debug("Accepted")
             self.assignments = new_assignments
-        else:
-            # logger.debug("Rejected")
-            pass
+            return True
+        # logger.debug("Rejected")
+        return False
 
     def propose_merge(self, x, y):
-        # Merge two clusters if the consensus sequences are same   # TODO: allow some diff when noise exists?
-        if self.cluster_cons(self.assignments[x]) == self.cluster_cons(self.assignments[y]):
-            logger.debug("Merge Accepted")
-            for i in range(self.N):
-                if self.assignments[i] == self.assignments[y]:
-                    self.assignments[i] = self.assignments[x]
-        else:
-            # logger.debug("Rejected")
-            pass
-
-        """
-        # Merge cluster <old_cluster_id_x> and <old_cluster_id_y> into <old_cluster_id_x>
+        # Merge cluster <old_cluster_id_y> into <old_cluster_id_x>
         old_cluster_id_x = self.assignments[x]
         old_cluster_id_y = self.assignments[y]
-        new_assignments = np.copy(self.assignments)
-        
-        # Change cluster assignment of the units in the cluster which units[y] belongs to
-        for i in range(self.N):
-            if new_assignments[i] == old_cluster_id_y:
-                new_assignments[i] = old_cluster_id_x
-        logger.debug(f"\nCurrent state:\n{self.assignments}\nProposed state:\n{new_assignments}")
-        
-        # Compare the probability of the current state and the proposed state
-        p_current = self.log_prob_clustering()
-        p_new = self.log_prob_clustering(new_assignments)
-        logger.debug(f"Current state prob: {p_current}, Proposed state prob: {p_new}")
+        new_assignments = np.where(self.assignments == old_cluster_id_y, old_cluster_id_x, self.assignments)
+
+        # Same consensus sequences never need to be split, so accept without computing that of the merged cluster
+        if self.cluster_cons(old_cluster_id_x) == self.cluster_cons(old_cluster_id_y):
+            logger.debug("Merge Accepted (same consensus)")
+            self.assignments = new_assignments
+            return True
+
+        # Compare the probability of the current state and the proposed state, only on the merged clusters
+        p_current = self.log_prob_clusters((old_cluster_id_x, old_cluster_id_y))
+        p_new = self.log_prob_clusters((old_cluster_id_x,), new_assignments)
+        logger.debug(
+            f"Current prob: {p_current:.0f}, Proposed prob: {p_new:.0f} (merged clusters only)")
         if p_current < p_new:
-            logger.debug("Accepted")
+            logger.debug("Merge Accepted")
             self.assignments = new_assignments
-        else:
-            logger.debug("Rejected")
-        """
+            return True
+        # logger.debug("Rejected")
+        return False
 
 
 def sync_reads_to_smc_inputs(sync_reads):
     # units/quals = [read1_unit1, read1_unit2, ..., read1_unitN, read2_unit1, ..., read_L_unit_M]
     units = [unit_seq for read in sync_reads for unit_seq in read.unit_seqs]
-    quals = [qual for read in sync_reads for qual in read.unit_quals]
+    quals = [qual for read in sync_reads
+             for qual in (read.unit_quals if read.quals is not None else [None] * len(read.units))]
     return (units, quals)
 
 
@@ -723,31 +1055,59 @@ def smc_outputs_to_reads(smc, sync_reads):
     return labeled_reads
 
 
-def filter_overlaps_by_smc(sync_reads, ward_th, alpha, read_id, plot=False):
+def filter_overlaps_by_smc(sync_reads, ward_th, alpha, read_id, plot=False, cons_engine="consed", seed=0,
+                           max_time=None, accept_window=3, min_accept_rate=0.01, metrics=None):
+    """Cluster the units of <sync_reads> by split-merge clustering and return the reads labeled by
+    the clusters.
+
+    Rounds of proposals and Gibbs sampling are repeated until the probability converges or oscillates,
+    the acceptance rate of proposals over the last <accept_window> rounds is below <min_accept_rate>,
+    or <max_time> seconds have passed. The number of proposals in a round is halved for each consecutive
+    round without acceptance. The stop reason and counts are written to a dict <metrics> if given.
+    """
     logger.debug(f"Start read {read_id}")
+    start_time = time.perf_counter()
 
-    smc = SplitMergeClustering(
-        *sync_reads_to_smc_inputs(sync_reads), alpha=alpha, read_id=read_id)
+    smc = SplitMergeClustering(*sync_reads_to_smc_inputs(sync_reads), alpha=alpha, read_id=read_id,
+                               cons_engine=cons_engine, seed=seed)
 
     # Initial clustering
-    c = ClusteringSeq(smc.units, revcomp=False)
-    c.calc_dist_mat()
-    if plot:
-        c.show_dendrogram()
-    c.cluster_hierarchical(threshold=ward_th)
+    with timer("init_clustering"):
+        c = ClusteringSeq(smc.units, revcomp=False)
+        c.calc_dist_mat()
+        if plot:
+            c.show_dendrogram()
+        c.cluster_hierarchical(threshold=ward_th)
     # TODO: remove single "outlier" units (probably from regions covered only once by these reads right here)
 
     smc.assignments = c.assignment
-    smc.do_gibbs()
+    with timer("gibbs"):
+        smc.do_gibbs()
 
     # Do samplings until convergence
     prev_p = smc.log_prob_clustering()
     p_counts = Counter()   # for oscillation
-    count = 0
+    n_same_prob = 0   # number of consecutive rounds with the same probability
     inf_count = 0
-    while count < 2:
-        smc.do_proposal(max(smc.n_clusters() * 10, 100))
-        smc.do_gibbs()
+    n_zero_accept = 0   # number of consecutive rounds without acceptance
+    history = []   # (n_proposals, n_accepted) for each round
+    stop_reason = "converged"
+    while n_same_prob < 2:
+        n_proposals = max(max(smc.n_clusters() * 10, 100) >> n_zero_accept, 10)
+        with timer("proposal"):
+            n_accepted = smc.do_proposal(n_proposals,
+                                         deadline=None if max_time is None else start_time + max_time)
+        history.append((n_proposals, n_accepted))
+        n_zero_accept = 0 if n_accepted > 0 else n_zero_accept + 1
+
+        # Checked before Gibbs sampling, which would otherwise overrun the limit by a whole sweep
+        if max_time is not None and time.perf_counter() - start_time > max_time:
+            logger.info(f"Read {read_id}: Time limit ({max_time} sec) exceeded. Stop.")
+            stop_reason = "time_limit"
+            break
+
+        with timer("gibbs"):
+            smc.do_gibbs()
         p = smc.log_prob_clustering()
 
         if p == -np.inf or prev_p == -np.inf:
@@ -756,35 +1116,172 @@ def filter_overlaps_by_smc(sync_reads, ward_th, alpha, read_id, plot=False):
             if inf_count >= 5:
                 logger.warn(
                     f"Read {read_id}: Non-resolvable -inf prob. Abort.")
+                stop_reason = "inf_prob"
                 break
             continue
 
         logger.debug(
-            f"Read {read_id}: {smc.n_clusters()} clusters, prob {int(prev_p)} -> {int(p)} ({count})")
+            f"Read {read_id}: {smc.n_clusters()} clusters, prob {int(prev_p)} -> {int(p)} ({n_same_prob})")
 
         if p_counts[int(p)] >= 5:   # oscillation
             logger.debug(f"Oscillation at read {read_id}. Stop.")
+            stop_reason = "oscillation"
             break
 
+        if len(history) >= accept_window:
+            window_proposals, window_accepted = np.sum(history[-accept_window:], axis=0)
+            if window_accepted < min_accept_rate * window_proposals:
+                logger.debug(f"Read {read_id}: No acceptance in the last {accept_window} rounds. Stop.")
+                stop_reason = "low_acceptance"
+                break
+
         if int(p) == int(prev_p):
-            count += 1
+            n_same_prob += 1
         else:
-            count = 0
+            n_same_prob = 0
 
         prev_p = p
         p_counts[int(p)] += 1
 
-    logger.debug(f"Finished read {read_id}")
+    logger.debug(f"Finished read {read_id} ({stop_reason})")
+    if metrics is not None:
+        metrics.update(stop_reason=stop_reason,
+                       n_rounds=len(history),
+                       n_proposals=sum([n for n, _ in history]),
+                       n_accepted=sum([n for _, n in history]),
+                       n_clusters=smc.n_clusters(),
+                       n_units=smc.N,
+                       n_consensus_calls=smc.n_consed_calls,
+                       n_cons_cache_hits=smc.n_cons_cache_hits,
+                       n_cons_loo_approx=smc.n_cons_loo_approx,
+                       time=round(time.perf_counter() - start_time, 3))
+    logger.info(f"Read {read_id}: {smc.n_consed_calls} Consed calls "
+                f"({smc.n_cons_cache_hits} calls saved by cache, "
+                f"{smc.n_cons_loo_approx} by leave-one-out approximation)")
 
     return smc_outputs_to_reads(smc, sync_reads)
 
 
-def run_single(read_id, overlaps, centromere_reads_by_id, ward_th, alpha):
-    sync_reads = synchronize_reads(overlaps, read_id, centromere_reads_by_id)
-    labeled_reads = filter_overlaps_by_smc(sync_reads, ward_th, alpha, read_id)
+def run_single(read_id, overlaps, centromere_reads_by_id, ward_th, alpha, cons_engine="consed", seed=0,
+               max_time=None, metrics=None):
+    """Synchronize the reads overlapping to <read_id> and cluster their units. The time of each phase and
+    the counts of events are written to a dict <metrics> if given."""
+    with profile() as profiler:
+        sync_reads = synchronize_reads(overlaps, read_id, centromere_reads_by_id, cons_engine=cons_engine,
+                                       seed=seed)
+    if metrics is not None:
+        metrics.update(profiler.metrics())
+    return run_smc(read_id, sync_reads, ward_th, alpha, cons_engine, seed, max_time, metrics)
+
+
+def run_smc(read_id, sync_reads, ward_th, alpha, cons_engine, seed, max_time, metrics=None):
+    if metrics is None:
+        metrics = {}
+    with profile() as profiler:
+        labeled_reads = filter_overlaps_by_smc(sync_reads, ward_th, alpha, read_id,
+                                               cons_engine=cons_engine, seed=seed, max_time=max_time,
+                                               metrics=metrics)
+    for name, value in profiler.metrics().items():
+        metrics[name] = round(metrics.get(name, 0) + value, 3)
+    logger.info(f"Read {read_id}: " + ", ".join([f"{k}={v}" for k, v in metrics.items()]))
     return (read_id, labeled_reads)
 
 
+def run_group(read_ids, overlaps, centromere_reads_by_id, ward_th, alpha, cons_engine="consed", seed=0,
+              max_time=None):
+    """Run `run_single` for each of <read_ids> whose reads are synchronized at once.
+    Return value is `[(read_id, labeled_reads, metrics)]`, where the time of the synchronization is
+    that of the whole group."""
+    if len(read_ids) == 1:
+        metrics = {}
+        read_id, labeled_reads = run_single(read_ids[0], overlaps, centromere_reads_by_id, ward_th, alpha,
+                                            cons_engine, seed, max_time, metrics)
+        return [(read_id, labeled_reads, metrics)]
+    with profile() as profiler:
+        sync_reads_by_target = synchronize_read_group(overlaps, read_ids, centromere_reads_by_id,
+                                                      cons_engine=cons_engine, seed=seed)
+    rets = []
+    for read_id in read_ids:
+        metrics = profiler.metrics()
+        rets.append((*run_smc(read_id, sync_reads_by_target[read_id], ward_th, alpha, cons_engine, seed,
+                              max_time, metrics),
+                     metrics))
+    return rets
+
+
+def run_group_global(read_ids):
+    """`run_group` with the inputs shared among the worker processes as global variables."""
+    return run_group(read_ids, overlaps, centromere_reads_by_id, args.ward_th, args.alpha,
+                     args.cons_engine, args.seed, args.max_time)
+
+
+def estimate_costs(overlaps, centromere_reads_by_id):
+    """Estimate the computation time of `run_single` for each read by the number of units involved
+    in the overlaps with the read. Return value is `{read_id: cost}`."""
+    involved_read_ids = defaultdict(set)
+    for o in overlaps:
+        involved_read_ids[o.a_read_id].add(o.b_read_id)
+        involved_read_ids[o.b_read_id].add(o.a_read_id)
+    return {read_id: sum([len(centromere_reads_by_id[involved_read_id].units)
+                          for involved_read_id in read_ids | set([read_id])])
+            for read_id, read_ids in involved_read_ids.items()}
+
+
+def append_journal(result, journal_fname):
+    """Append a result of `run_single` to a journal file so that it is not lost even if the job is killed."""
+    with open(journal_fname, 'ab') as f:
+        pickle.dump(result, f)
+        f.flush()
+
+
+# Columns of the per-read metrics file written next to each output file
+metrics_columns = ("read_id", "stop_reason", "time", "n_units", "n_clusters", "n_rounds", "n_proposals",
+                   "n_accepted", "repr_units_time", "sync_units_time", "init_clustering_time", "gibbs_time",
+                   "proposal_time", "consensus_time", "likelihood_time", "n_consensus_calls",
+                   "n_cons_cache_hits", "n_cons_loo_approx", "n_log_prob_cache_hits", "n_edlib_calls")
+
+
+def append_metrics(read_id, metrics, metrics_fname):
+    """Append the metrics of a read computed by `run_group` to a TSV file, with a header if it is new."""
+    is_new = not os.path.exists(metrics_fname)
+    with open(metrics_fname, 'a') as f:
+        if is_new:
+            f.write('\t'.join(metrics_columns) + '\n')
+        f.write('\t'.join([str(read_id)] + [str(metrics.get(column, 0)) for column in metrics_columns[1:]])
+                + '\n')
+
+
+def rewrite_metrics(metrics_fname, read_ids):
+    """Rewrite the metrics file written by `append_metrics` so that it keeps only the first row of each
+    read in <read_ids> (e.g. the reads in the journal), dropping the rows of reads to be recomputed."""
+    if not os.path.exists(metrics_fname):
+        return
+    read_ids = set(map(str, read_ids))
+    with open(metrics_fname, 'r') as f:
+        header, *rows = f.readlines()
+    with open(metrics_fname, 'w') as f:
+        f.write(header)
+        for row in rows:
+            read_id = row.split('\t', 1)[0]
+            if read_id in read_ids and row.endswith('\n'):
+                f.write(row)
+                read_ids.remove(read_id)
+
+
+def load_journal(journal_fname):
+    """Load the results written by `append_journal`. A record truncated by a killed job is ignored."""
+    results = []
+    if not os.path.exists(journal_fname):
+        return results
+    with open(journal_fname, 'rb') as f:
+        while True:
+            try:
+                results.append(pickle.load(f))
+            except (EOFError, pickle.UnpicklingError):
+                break
+    return results
+
+
 if __name__ == "__main__":
     p = argparse.ArgumentParser()
     p.add_argument("centromere_reads_fname", type=str)
@@ -795,21 +1292,47 @@ if __name__ == "__main__":
     p.add_argument("ward_th", type=float)
     p.add_argument("alpha", type=float)
     p.add_argument("index", type=int)
+    p.add_argument("--sync_group_size", type=int, default=1)
+    p.add_argument("--cons_engine", type=str, default="consed", choices=consensus_engines)
+    p.add_argument("--seed", type=int, default=0)
+    p.add_argument("--max_time", type=float, default=None)
     args = p.parse_args()
 
+    global centromere_reads_by_id
+    global overlaps
     centromere_reads = load_pickle(args.centromere_reads_fname)
     centromere_reads_by_id = {read.id: read for read in centromere_reads}
-
     overlaps = load_pickle(args.overlaps_fname)
-    read_ids = sorted(
-        set([read_id for o in overlaps for read_id in (o.a_read_id, o.b_read_id)]))
 
-    unit_n = -(-len(read_ids) // args.n_distribute)
-    read_ids = read_ids[args.index * unit_n:(args.index + 1) * unit_n]
+    # Distribute groups of reads to the jobs in the descending order of their costs
+    # so that the total costs are even
+    costs = estimate_costs(overlaps, centromere_reads_by_id)
+    read_ids = sorted(costs.keys(), key=lambda read_id: costs[read_id], reverse=True)
+    groups = group_target_reads(read_ids, overlaps, args.sync_group_size)
+    groups.sort(key=lambda group: sum([costs[read_id] for read_id in group]), reverse=True)
+    groups = groups[args.index::args.n_distribute]
+
+    # Skip the reads already finished in a previous run of this job
+    journal_fname = f"{args.out_fname}.journal"
+    metrics_fname = f"{args.out_fname}.metrics.tsv"
+    labeled_reads = load_journal(journal_fname)
+    rewrite_metrics(metrics_fname, [read_id for read_id, _ in labeled_reads])
+    if len(labeled_reads) > 0:
+        finished_read_ids = set([read_id for read_id, _ in labeled_reads])
+        logger.info(f"Resume: {len(finished_read_ids)} reads have been already finished")
+        groups = [[read_id for read_id in group if read_id not in finished_read_ids] for group in groups]
+        groups = [group for group in groups if len(group) > 0]
+        # Rewrite the journal without a truncated record, if any
+        with open(journal_fname, 'wb') as f:
+            for ret in labeled_reads:
+                pickle.dump(ret, f)
+
+    # Dispatch the groups from the largest one to idle workers, and write each result once it is finished
     with NoDaemonPool(args.n_core) as pool:
-        # TODO: change to global variables same as ava_unsync
-        labeled_reads = list(pool.starmap(run_single, [(read_id, overlaps, centromere_reads_by_id,
-                                                        args.ward_th, args.alpha)
-                                                       for read_id in read_ids]))
+        for rets in pool.imap_unordered(run_group_global, groups):
+            for read_id, reads, metrics in rets:
+                append_journal((read_id, reads), journal_fname)
+                append_metrics(read_id, metrics, metrics_fname)
+                labeled_reads.append((read_id, reads))
 
     save_pickle(labeled_reads, args.out_fname)
@@ -61,8 +61,33 @@ def svs_overlap_forward(boundary_read, whole_read, offset, k_for_unit, min_kmer_
     return match_poss
 
 
+def cluster_match_poss(match_poss, max_diag_slip):
+    """Group match positions `(a_match_pos, b_match_pos, strand)` lying on (almost) the same
+    overlap diagonal `a_match_pos - b_match_pos`. Match positions shifted along a diagonal by
+    multiples of the unit length, or found from both of the prefix and suffix boundaries,
+    result in the same dovetail overlap.
+    Each cluster is a list whose first element is its representative (= median diagonal) and
+    the others follow in order of their distance from the representative.
+    """
+    clusters = []
+    for strand in (0, 1):
+        poss = sorted([(a_match_pos - b_match_pos, a_match_pos, b_match_pos)
+                       for a_match_pos, b_match_pos, s in match_poss if s == strand])
+        diag_clusters = []
+        for pos in poss:
+            if len(diag_clusters) == 0 or pos[0] - diag_clusters[-1][0][0] > max_diag_slip:
+                diag_clusters.append([])
+            diag_clusters[-1].append(pos)
+        for cluster in diag_clusters:
+            repr_diag = cluster[len(cluster) // 2][0]
+            clusters.append([(a_match_pos, b_match_pos, strand)
+                             for diag, a_match_pos, b_match_pos
+                             in sorted(cluster, key=lambda x: abs(x[0] - repr_diag))])
+    return clusters
+
+
 def svs_overlap(a_read, b_read, a_read_rc, b_read_rc,
-                offset, k_for_unit, min_kmer_ovlp, max_init_diff, max_diff,
+                offset, k_for_unit, min_kmer_ovlp, max_init_diff, max_diff, max_diag_slip,
                 read_forward_specs, read_boundary_specs):
     match_pos_a_to_b = set([(a_match_pos, b_match_pos, 0)
                             for a_match_pos, b_match_pos
@@ -86,15 +111,18 @@ def svs_overlap(a_read, b_read, a_read_rc, b_read_rc,
                                                     read_forward_specs, read_boundary_specs)])
     match_poss = match_pos_a_to_b | match_pos_b_to_a | match_pos_ar_to_b | match_pos_br_to_a
 
+    # Verify only the representative of each diagonal, and the others only when it fails
     overlaps = set()
-    for a_match_pos, b_match_pos, strand in match_poss:
-        a_start, a_end, b_start, b_end, length, diff = \
-            dovetail_alignment(a_read.seq, (b_read if strand == 0 else b_read_rc).seq,
-                               a_match_pos, b_match_pos)
-        if diff > max_diff:
-            continue
-        overlaps.add(Overlap(a_read.id, b_read.id, strand,
-                             a_start, a_end, a_read.length,
-                             b_start, b_end, b_read.length,
-                             round(100 * diff, 2)))
+    for cluster in cluster_match_poss(match_poss, max_diag_slip):
+        for a_match_pos, b_match_pos, strand in cluster:
+            a_start, a_end, b_start, b_end, length, diff = \
+                dovetail_alignment(a_read.seq, (b_read if strand == 0 else b_read_rc).seq,
+                                   a_match_pos, b_match_pos)
+            if diff > max_diff:
+                continue
+            overlaps.add(Overlap(a_read.id, b_read.id, strand,
+                                 a_start, a_end, a_read.length,
+                                 b_start, b_end, b_read.length,
+                                 round(100 * diff, 2)))
+            break
     return sorted(overlaps)
@@ -0,0 +1,135 @@
+from collections import Counter
+import numpy as np
+from BITS.seq.align import EdlibRunner
+from .profiler import count
+
+er_global = EdlibRunner("global", revcomp=False, cyclic=False)
+
+# Bases of the pileup columns. Any character other than 'acgt' (case-insensitive) is counted as '-'.
+bases = "acgt-"
+gap_code = bases.index('-')
+base_codes = np.full(256, gap_code, dtype=np.uint8)
+for code, base in enumerate(bases[:-1]):
+    base_codes[ord(base)] = base_codes[ord(base.upper())] = code
+
+
+def encode_seq(seq):
+    """Convert a sequence into an array of the indices of `bases`."""
+    return base_codes[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+
+def fcigar_positions(fcigar, consuming_ops):
+    """Return the operations of a flatten CIGAR <fcigar> as an array and, for each operation, the position
+    on the sequence consumed by <consuming_ops> (i.e., the number of the consuming operations before it)."""
+    ops = np.frombuffer(fcigar.encode(), dtype=np.uint8)
+    consumes = np.isin(ops, [ord(c) for c in consuming_ops])
+    return (ops, np.cumsum(consumes) - consumes)
+
+
+def align_columns(seed, seq):
+    """Globally align <seq> to <seed> and return the pileup cells which <seq> occupies as a tuple of arrays
+    `(poss, indices, codes)`. A cell `(pos, 0)` is the column of `seed[pos]`, and `(pos, index)` with
+    `index > 0` is the column of the <index>-th base inserted between `seed[pos - 1]` and `seed[pos]`.
+    `codes` are the indices of the bases of <seq> in `bases`.
+    """
+    assert seed != "" and seq != "", "Empty strings are not allowed"
+    fcigar = er_global.align(seq.lower(), seed.lower()).cigar.flatten().string   # NOTE: seq vs seed
+    count("edlib_calls")
+    ops, poss = fcigar_positions(fcigar, "=XD")
+    _, seq_poss = fcigar_positions(fcigar, "=XI")
+    assert poss[-1] + (ops[-1] != ord('I')) == len(seed)
+
+    is_ins = ops == ord('I')
+    n_ops = len(ops)
+    last_non_ins = np.maximum.accumulate(np.where(is_ins, -1, np.arange(n_ops)))
+    indices = np.where(is_ins, np.arange(n_ops) - last_non_ins, 0)
+    codes = np.where(ops == ord('D'), gap_code, encode_seq(seq)[np.minimum(seq_poss, len(seq) - 1)])
+    return (poss, indices, codes.astype(np.uint8))
+
+
+def pileup(seed, seqs, columns=None):
+    """Return the count tensor `counts[pos, index, base]` of the pileup of <seqs> aligned to <seed>,
+    whose shape is `(len(seed) + 1, max_index + 1, len(bases))` (see `align_columns` for the cells).
+    Sequences without insertion at an insertion column are counted as '-'.
+    <columns> can be given as the precomputed outputs of `align_columns` for <seqs>.
+    """
+    if columns is None:
+        columns = [align_columns(seed, seq) for seq in seqs]
+    max_index = max([np.max(indices, initial=0) for poss, indices, codes in columns], default=0)
+    counts = np.zeros((len(seed) + 1, max_index + 1, len(bases)), dtype=np.int64)
+    if len(columns) > 0:
+        np.add.at(counts, tuple(np.concatenate(x) for x in zip(*columns)), 1)
+    counts[:, 1:, gap_code] = len(columns) - np.sum(counts[:, 1:, :gap_code], axis=2)
+    return counts
+
+
+def remove_columns(counts, columns):
+    """Return a copy of the count tensor <counts> from which a sequence with pileup cells <columns> is removed."""
+    poss, indices, codes = columns
+    counts = counts.copy()
+    np.subtract.at(counts, (poss, indices, codes), 1)
+    # The sequence had been counted as '-' at the insertion columns where it has no insertion
+    counts[:, 1:, gap_code] -= 1
+    is_ins = indices > 0
+    np.add.at(counts, (poss[is_ins], indices[is_ins], gap_code), 1)
+    return counts
+
+
+def seed_codes(seed, counts):
+    """Return the indices of the bases of <seed> for every cell of <counts>, where insertion columns
+    (and the last position) are '-'."""
+    codes = np.full(counts.shape[:2], gap_code, dtype=np.uint8)
+    codes[:len(seed), 0] = encode_seq(seed)
+    return codes
+
+
+def majority_vote(counts, seed=None):
+    """Return the index of the most frequent base for each cell of <counts>. Ties are broken by the order
+    of `bases`, unless <seed> is given, in which case the base of the seed wins ties."""
+    votes = np.argmax(counts, axis=2)
+    if seed is not None:
+        codes = seed_codes(seed, counts)
+        seed_counts = np.take_along_axis(counts, codes[:, :, None].astype(np.int64), axis=2)[:, :, 0]
+        votes = np.where(seed_counts >= np.max(counts, axis=2), codes, votes)
+    return votes
+
+
+def list_variants(seed, counts):
+    """List up `(pos, index, op, base)` of the cells of <counts> having any base different from the seed,
+    where `op` is 'X', 'D' or 'I' as in CIGAR and `base` is a base of `bases`, together with the counts."""
+    codes = seed_codes(seed, counts)
+    variants = []
+    for pos, index, code in zip(*np.nonzero(counts)):
+        if code == codes[pos, index]:
+            continue
+        op = 'I' if index > 0 else 'D' if code == gap_code else 'X'
+        variants.append(((int(pos), int(index), op, bases[code]), int(counts[pos, index, code])))
+    return variants
+
+
+def count_variants(cluster_cons_unit, cluster_units):
+    """Given a set of unit sequences <cluster_units> in a cluster, count the variations (= bases inconsistent
+    with <cluster_cons_unit> on the pileup of <cluster_units> using <cluster_cons_unit> as a seed).
+    Return value is `Counter({(pos, index, op, base): count})`.
+    Since a cluster should be homogeneous (i.e., mono-source), the relative frequencies are
+    expected to be not much larger than sequencing error.
+    """
+    return Counter(dict(list_variants(cluster_cons_unit, pileup(cluster_cons_unit, cluster_units))))
+
+
+def vote_consensus(seed, counts, votes):
+    """Return the consensus sequence given the majority votes <votes> for each cell of the count tensor
+    <counts> of the pileup on <seed>. The bases of <seed> are kept as they are (e.g. in case) if voted."""
+    seed_votes = seed_codes(seed, counts)
+    cons = ""
+    for pos in range(len(seed) + 1):
+        # insertions
+        for index in range(1, counts.shape[1]):
+            if np.sum(counts[pos, index, :gap_code]) == 0:
+                break
+            cons += bases[votes[pos, index]]
+        if pos == len(seed):
+            break
+        # others
+        cons += seed[pos] if votes[pos, 0] == seed_votes[pos, 0] else bases[votes[pos, 0]]
+    return cons.replace('-', '')
@@ -0,0 +1,63 @@
+import time
+from dataclasses import dataclass
+from collections import Counter
+from contextlib import contextmanager
+
+
+@dataclass(eq=False)
+class Profiler:
+    """Accumulator of the elapsed time of named phases and the counts of named events.
+    Timers of nested phases are inclusive (e.g. "consensus" is also counted in "gibbs" when called from it).
+    """
+
+    def __post_init__(self):
+        self.times = Counter()   # {phase: total seconds}
+        self.counts = Counter()   # {event: total count}
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    def metrics(self):
+        """Return `{f"{phase}_time": seconds, f"n_{event}": count}`."""
+        return {**{f"{name}_time": round(t, 3) for name, t in self.times.items()},
+                **{f"n_{name}": n for name, n in self.counts.items()}}
+
+
+# Profiler to which `timer` and `count` are recorded. Nothing is recorded outside of `profile`.
+active_profiler = None
+
+
+@contextmanager
+def profile():
+    """Record `timer` and `count` in the block to a new profiler, which is yielded.
+    The previously active profiler (if any) is restored after the block."""
+    global active_profiler
+    prev_profiler, active_profiler = active_profiler, Profiler()
+    try:
+        yield active_profiler
+    finally:
+        active_profiler = prev_profiler
+
+
+@contextmanager
+def timer(name):
+    """Measure the elapsed time of the block as the phase <name> of the active profiler."""
+    if active_profiler is None:
+        yield
+        return
+    with active_profiler.timer(name):
+        yield
+
+
+def count(name, n=1):
+    """Count the event <name> <n> times in the active profiler."""
+    if active_profiler is not None:
+        active_profiler.count(name, n)
@@ -171,3 +171,26 @@ class Overlap:
 
     def astuple(self):
         return astuple(self)
+
+
+# Structured array version of List[Overlap], for filtering a huge number of overlaps
+overlap_dtype = np.dtype([("a_read_id", np.int64),
+                          ("b_read_id", np.int64),
+                          ("strand"   , np.int8),
+                          ("a_start"  , np.int64),
+                          ("a_end"    , np.int64),
+                          ("a_len"    , np.int64),
+                          ("b_start"  , np.int64),
+                          ("b_end"    , np.int64),
+                          ("b_len"    , np.int64),
+                          ("diff"     , np.float64)])
+
+
+def overlaps_to_array(overlaps):
+    """Convert `overlaps` <List[Overlap]> into a structured array of `overlap_dtype`."""
+    return np.array([o.astuple() for o in overlaps], dtype=overlap_dtype)
+
+
+def array_to_overlaps(overlaps):
+    """Convert a structured array of `overlap_dtype` into List[Overlap]."""
+    return [Overlap(*o) for o in overlaps.tolist()]